@@ -4,8 +4,14 @@ import os
 import numpy as np
 import tensorflow as tf
 from time import strftime, time
-from utils import plot_SR_data
-from sr_network import SR_NETWORK
+from utils import SRPlotter, tiled_super_resolve, SRDataWriter, ProgressLog, tfrecord_compression, decode_tfrecord_data, expand_data_paths, \
+                  import_frozen_generator
+from manifest import load_manifest
+from sr_store import SRStoreWriter, CHANNEL_NAMES
+from metrics import MetricsLogger
+from record_index import shuffled_record_dataset
+from checkpointing import CheckpointManager, latest_checkpoint
+from sr_network import SR_NETWORK, build_testing_generator
 
 class PhIREGANs:
     # Network training meta-parameters
@@ -13,20 +19,48 @@ class PhIREGANs:
     DEFAULT_LEARNING_RATE = 1e-4 # Learning rate for gradient descent (may decrease to 1e-5 after initial training)
     DEFAULT_EPOCH_SHIFT = 0 # If reloading previously trained network, what epoch to start at
     DEFAULT_SAVE_EVERY = 10 # How frequently (in epochs) to save model weights
+    DEFAULT_KEEP_CHECKPOINTS = 5 # Number of most recent epoch checkpoints kept on disk besides the best by loss (None keeps all)
     DEFAULT_PRINT_EVERY = 2 # How frequently (in iterations) to write out performance
-
-    def __init__(self, data_type, N_epochs=None, learning_rate=None, epoch_shift=None, save_every=None, print_every=None, mu_sig=None):
+    DEFAULT_SHUFFLE_BUFFER = 1000 # Number of records held in the training shuffle buffer
+    DEFAULT_NUM_PARALLEL_CALLS = 4 # Number of records parsed in parallel by the data pipeline
+    DEFAULT_PREFETCH = 2 # Number of batches prepared ahead of the training step
+    DEFAULT_CYCLE_LENGTH = 4 # Number of TFRecord shards read in parallel
+    DEFAULT_GLOBAL_SHUFFLE = False # Read training records in a globally shuffled order through an offset index (uncompressed TFRecords only)
+    DEFAULT_TILE_HALO = 40 # LR pixels of context around each tile in tiled inference (generator receptive field is ~36)
+    DEFAULT_FLUSH_EVERY = 10 # How frequently (in batches) test() syncs its output to disk and records its progress
+    DEFAULT_TRACE_EVERY = 0 # How frequently (in iterations) to capture a full step trace when logging metrics, 0 disables
+    DEFAULT_GRAPH_CACHE_DIR = None # Directory of serialized testing graphs reused by test() instead of rebuilding the network, None disables
+
+    def __init__(self, data_type, N_epochs=None, learning_rate=None, epoch_shift=None, save_every=None, print_every=None, mu_sig=None,
+                 shuffle_buffer=None, num_parallel_calls=None, prefetch=None, cycle_length=None, metrics_path=None, trace_every=None,
+                 keep_checkpoints=DEFAULT_KEEP_CHECKPOINTS, graph_cache_dir=DEFAULT_GRAPH_CACHE_DIR, global_shuffle=DEFAULT_GLOBAL_SHUFFLE):
 
         self.N_epochs      = N_epochs if N_epochs is not None else self.DEFAULT_N_EPOCHS
         self.learning_rate = learning_rate if learning_rate is not None else self.DEFAULT_LEARNING_RATE
         self.epoch_shift   = epoch_shift if epoch_shift is not None else self.DEFAULT_EPOCH_SHIFT
         self.save_every    = save_every if save_every is not None else self.DEFAULT_SAVE_EVERY
         self.print_every   = print_every if print_every is not None else self.DEFAULT_PRINT_EVERY
+        self.keep_checkpoints = keep_checkpoints
+
+        self.shuffle_buffer     = shuffle_buffer if shuffle_buffer is not None else self.DEFAULT_SHUFFLE_BUFFER
+        self.num_parallel_calls = num_parallel_calls if num_parallel_calls is not None else self.DEFAULT_NUM_PARALLEL_CALLS
+        self.prefetch           = prefetch if prefetch is not None else self.DEFAULT_PREFETCH
+        self.cycle_length       = cycle_length if cycle_length is not None else self.DEFAULT_CYCLE_LENGTH
+        self.global_shuffle     = global_shuffle
+
+        # JSONL file for per-step/per-epoch metrics (see metrics.py), None disables logging
+        self.metrics_path = metrics_path
+        self.trace_every  = trace_every if trace_every is not None else self.DEFAULT_TRACE_EVERY
+
+        self.graph_cache_dir = graph_cache_dir
 
         self.data_type = data_type
         self.mu_sig = mu_sig
         self.LR_data_shape = None
 
+        # Communicator of a data-parallel job (see distributed.py), None for single-process training
+        self.comm = None
+
         # Set various paths for where to save data
         self.run_id        = '-'.join([self.data_type, strftime('%Y%m%d-%H%M%S')])
         self.model_name    = '/'.join(['models', self.run_id])
@@ -38,6 +72,9 @@ class PhIREGANs:
     def setPrint_every(self, in_print_every):
         self.print_every = in_print_every
 
+    def setKeep_checkpoints(self, in_keep_checkpoints):
+        self.keep_checkpoints = in_keep_checkpoints
+
     def setEpochShift(self, shift):
         self.epoch_shift = shift
 
@@ -47,6 +84,33 @@ class PhIREGANs:
     def setLearnRate(self, learn_rate):
         self.learning_rate = learn_rate
 
+    def setShuffle_buffer(self, in_shuffle_buffer):
+        self.shuffle_buffer = in_shuffle_buffer
+
+    def setNum_parallel_calls(self, in_num_parallel_calls):
+        self.num_parallel_calls = in_num_parallel_calls
+
+    def setPrefetch(self, in_prefetch):
+        self.prefetch = in_prefetch
+
+    def setCycle_length(self, in_cycle_length):
+        self.cycle_length = in_cycle_length
+
+    def setGlobal_shuffle(self, in_global_shuffle):
+        self.global_shuffle = in_global_shuffle
+
+    def setMetrics_path(self, in_metrics_path):
+        self.metrics_path = in_metrics_path
+
+    def setTrace_every(self, in_trace_every):
+        self.trace_every = in_trace_every
+
+    def setGraph_cache_dir(self, in_graph_cache_dir):
+        self.graph_cache_dir = in_graph_cache_dir
+
+    def setCommunicator(self, in_comm):
+        self.comm = in_comm
+
     def setModel_name(self, in_model_name):
         self.model_name = in_model_name
 
@@ -58,7 +122,7 @@ class PhIREGANs:
         self.model_name    = '/'.join(['models', self.run_id])
         self.data_out_path = '/'.join(['data_out', self.run_id])
 
-    def pretrain(self, r, data_path, model_path=None, batch_size=100):
+    def pretrain(self, r, data_path, model_path=None, batch_size=100, feed_dict_mode=False, accum_steps=1, patch_size=None, LR_from_HR=False):
         '''
             This method trains the generator without using a disctiminator/adversarial training. 
             This method should be called to sufficiently train the generator to produce decent images before 
@@ -66,44 +130,54 @@ class PhIREGANs:
 
             inputs:
                 r          - (int array) should be array of prime factorization of amount of super-resolution to perform
-                data_path  - (string) path of training data file to load in
-                model_path - (string) path of previously trained model to load in if continuing training
+                data_path  - (string or list of strings) path, glob pattern, or list of paths of training data shards
+                model_path - (string) path of previously trained model to load in if continuing training. If a
+                             model directory (a previous model_name) is given, training resumes from its latest
+                             checkpoint and epoch, and new checkpoints are saved to the same directory
                 batch_size - (int) number of images to grab per batch. decrease if running out of memory
+                feed_dict_mode - (bool) pull each batch into NumPy and feed it back through placeholders
+                                 instead of staging it inside the graph
+                accum_steps    - (int) number of micro-batches of batch_size whose gradients are accumulated per
+                                 weight update, for an effective batch of accum_steps*batch_size at the memory
+                                 cost of batch_size
+                patch_size     - (int) train on randomly placed, aligned patch_size x patch_size LR patches and the
+                                 matching HR patches instead of whole samples. None uses whole samples
+                LR_from_HR     - (bool) synthesize the LR data by averaging the HR data over prod(r) x prod(r) blocks
+                                 instead of reading it, so records only need to store HR data
 
             output:
                 saved_model - (string) path to the trained model
         '''
         
         tf.reset_default_graph()
+
+        if model_path is not None and os.path.isdir(model_path):
+            model_path = self._resume(model_path, ['cnn'])
         
         if self.mu_sig is None:
             self.set_mu_sig(data_path, batch_size)
         
-        self.set_LR_data_shape(data_path)
+        self.set_LR_data_shape(data_path, r if LR_from_HR else None)
         h, w, C = self.LR_data_shape
 
-        print('Initializing network ...', end=' ')
-        x_LR = tf.placeholder(tf.float32, [None, h,             w,            C])
-        x_HR = tf.placeholder(tf.float32, [None, h*np.prod(r),  w*np.prod(r), C])
+        print('Building data pipeline ...', end=' ')
+        init_iter, x_LR, x_HR, next_batch = self._build_train_inputs(data_path, r, batch_size, feed_dict_mode, accum_steps,
+                                                                     patch_size, LR_from_HR)
+        print('Done.')
 
+        print('Initializing network ...', end=' ')
         model = SR_NETWORK(x_LR, x_HR, r=r, status='pretraining')
 
         optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        g_train_op = optimizer.minimize(model.g_loss, var_list= model.g_variables)
-        init = tf.global_variables_initializer()
-
-        g_saver = tf.train.Saver(var_list=model.g_variables, max_to_keep=10000)
-        print('Done.')
-
-        print('Building data pipeline ...', end=' ')
-        ds = tf.data.TFRecordDataset(data_path)
-        ds = ds.map(lambda xx: self._parse_train_(xx, self.mu_sig)).shuffle(1000).batch(batch_size)
-
-        iterator = tf.data.Iterator.from_structure(ds.output_types,
-                                                   ds.output_shapes)
-        idx, LR_out, HR_out = iterator.get_next()
-
-        init_iter = iterator.make_initializer(ds)
+        if accum_steps > 1 or self.comm is not None:
+            g_train_op = self._accumulate_gradients(optimizer, model.g_loss, model.g_variables, tf.shape(x_LR)[0], 'g_accum')
+        else:
+            g_train_op = optimizer.minimize(model.g_loss, var_list= model.g_variables)
+        checkpoints = CheckpointManager(self.model_name, [('cnn', 'cnn', model.g_variables)], self.keep_checkpoints)
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+        g_saver = tf.train.Saver(var_list=model.g_variables)
+        metrics = MetricsLogger(self.metrics_path, self.trace_every)
         print('Done.')
 
         with tf.Session() as sess:
@@ -116,69 +190,91 @@ class PhIREGANs:
                 g_saver.restore(sess, model_path)
                 print('Done.')
 
+            if self.comm is not None:
+                # All workers start from the weights of rank 0
+                self.comm.broadcast_variables(sess, model.g_variables)
+
             # Start training
-            iters = 0
+            iters, epoch_loss = 0, None
             for epoch in range(self.epoch_shift+1, self.epoch_shift+self.N_epochs+1):
                 print('Epoch: %d' %(epoch))
                 start_time = time()
 
                 sess.run(init_iter)
                 try:
-                    epoch_loss, N = 0, 0
+                    epoch_loss, N, data_time, compute_time = 0, 0, 0., 0.
                     while True:
-                        batch_idx, batch_LR, batch_HR = sess.run([idx, LR_out, HR_out])
-                        N_batch = batch_LR.shape[0]
-                        feed_dict = {x_HR:batch_HR, x_LR:batch_LR}
-
-                        # Training step of the generator
-                        sess.run(g_train_op, feed_dict=feed_dict)
+                        t0 = time()
+                        N_batch, feed_dicts = self._next_batch(sess, next_batch)
+                        t1 = time()
 
-                        # Calculate current losses
-                        gl = sess.run(model.g_loss, feed_dict={x_HR: batch_HR, x_LR: batch_LR})
+                        # Training step of the generator, loss is computed in the same pass
+                        trace = metrics.trace_options(iters+1)
+                        gl = self._run_step(sess, g_train_op, model.g_loss, feed_dicts, **trace)
+                        t2 = time()
 
                         epoch_loss += gl*N_batch
                         N += N_batch
+                        data_time += t1 - t0
+                        compute_time += t2 - t1
 
                         iters += 1
+                        metrics.log('step', 'pretrain', epoch=epoch, iter=iters, N=N_batch, g_loss=gl,
+                                    data_time=t1-t0, compute_time=t2-t1, samples_per_sec=N_batch/(t2-t0))
+                        metrics.write_trace('pretrain', iters, trace)
                         if (iters % self.print_every) == 0:
                             print('Iteration=%d, G loss=%.5f' %(iters, gl))
 
                 except tf.errors.OutOfRangeError:
                     pass
 
-                if (epoch % self.save_every) == 0:
-                    model_dir = '/'.join([self.model_name, 'cnn{0:05d}'.format(epoch)])
-                    if not os.path.exists(model_dir):
-                        os.makedirs(model_dir)
-                    saved_model = '/'.join([model_dir, 'cnn'])
-                    g_saver.save(sess, saved_model)
-
                 epoch_loss = epoch_loss/N
 
+                if (epoch % self.save_every) == 0 and self._is_chief():
+                    # Written in the background while the next epoch trains
+                    checkpoints.save(sess, epoch, epoch_loss)
+
+                epoch_time = time() - start_time
+                metrics.log('epoch', 'pretrain', epoch=epoch, iter=iters, N=N, g_loss=epoch_loss, seconds=epoch_time,
+                            data_time=data_time, compute_time=compute_time, samples_per_sec=N/epoch_time)
+                metrics.flush()
                 print('Epoch generator training loss=%.5f' %(epoch_loss))
-                print('Epoch took %.2f seconds\n' %(time() - start_time), flush=True)
+                print('Epoch took %.2f seconds (%.2f samples/sec)\n' %(epoch_time, N/epoch_time), flush=True)
 
-            model_dir = '/'.join([self.model_name, 'cnn'])
-            if not os.path.exists(self.model_name):
-                os.makedirs(self.model_name)
-            saved_model = '/'.join([model_dir, 'cnn'])
-            g_saver.save(sess, saved_model)
+            saved_model = '/'.join([self.model_name, 'cnn', 'cnn'])
+            if self._is_chief():
+                checkpoints.save(sess, self.epoch_shift+self.N_epochs, epoch_loss, final=True)
+            checkpoints.close()
+            if self.comm is not None:
+                # The final checkpoint is on disk before any worker returns its path
+                self.comm.barrier()
 
+        metrics.close()
         print('Done.')
 
         return saved_model
 
-    def train(self, r, data_path, model_path, batch_size=100, alpha_advers=0.001):
+    def train(self, r, data_path, model_path, batch_size=100, alpha_advers=0.001, feed_dict_mode=False, accum_steps=1,
+              patch_size=None, LR_from_HR=False):
         '''
             This method trains the generator using a disctiminator/adversarial training. 
             This method should be called after a sufficiently pretrained generator has been saved.
 
             inputs:
                 r            - (int array) should be array of prime factorization of amount of super-resolution to perform
-                data_path    - (string) path of training data file to load in
-                model_path   - (string) path of previously pretrained or trained model to load
+                data_path    - (string or list of strings) path, glob pattern, or list of paths of training data shards
+                model_path   - (string) path of previously pretrained or trained model to load. If a model directory
+                               (a previous model_name) is given, training resumes from its latest gan-all/gan
+                               checkpoint and epoch, or starts from its latest pretrained cnn checkpoint
                 batch_size   - (int) number of images to grab per batch. decrease if running out of memory
                 alpha_advers - (float) scaling value for the effect of the discriminator
+                feed_dict_mode - (bool) pull each batch into NumPy and feed it back through placeholders
+                                 instead of staging it inside the graph
+                accum_steps    - (int) number of micro-batches of batch_size whose gradients are accumulated per
+                                 weight update of either network, for an effective batch of accum_steps*batch_size.
+                                 The G/D balancing then uses losses over the whole effective batch
+                patch_size     - (int) train on randomly placed, aligned LR/HR patch pairs, see pretrain
+                LR_from_HR     - (bool) synthesize the LR data from the HR data, see pretrain
 
             output:
                 g_saved_model - (string) path to the trained generator model
@@ -187,37 +283,40 @@ class PhIREGANs:
         tf.reset_default_graph()
 
         assert model_path is not None, 'Must provide path for pretrained model'
+
+        if os.path.isdir(model_path):
+            model_path = self._resume(model_path, ['gan-all', 'gan'], start_names=['cnn'])
         
         if self.mu_sig is None:
             self.set_mu_sig(data_path, batch_size)
         
-        self.set_LR_data_shape(data_path)
+        self.set_LR_data_shape(data_path, r if LR_from_HR else None)
         h, w, C = self.LR_data_shape
 
-        print('Initializing network ...', end=' ')
-        x_LR = tf.placeholder(tf.float32, [None, h,             w,            C])
-        x_HR = tf.placeholder(tf.float32, [None, h*np.prod(r),  w*np.prod(r), C])
+        print('Building data pipeline ...', end=' ')
+        init_iter, x_LR, x_HR, next_batch = self._build_train_inputs(data_path, r, batch_size, feed_dict_mode, accum_steps,
+                                                                     patch_size, LR_from_HR)
+        print('Done.')
 
+        print('Initializing network ...', end=' ')
         model = SR_NETWORK(x_LR, x_HR, r=r, status='training', alpha_advers=alpha_advers)
 
         optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        g_train_op = optimizer.minimize(model.g_loss, var_list=model.g_variables)
-        d_train_op = optimizer.minimize(model.d_loss, var_list=model.d_variables)
-        init = tf.global_variables_initializer()
-
-        g_saver = tf.train.Saver(var_list=model.g_variables, max_to_keep=10000)
-        gd_saver = tf.train.Saver(var_list=(model.g_variables+model.d_variables), max_to_keep=10000)
-        print('Done.')
-
-        print('Building data pipeline ...', end=' ')
-        ds = tf.data.TFRecordDataset(data_path)
-        ds = ds.map(lambda xx: self._parse_train_(xx, self.mu_sig)).shuffle(1000).batch(batch_size)
-
-        iterator = tf.data.Iterator.from_structure(ds.output_types,
-                                                   ds.output_shapes)
-        idx, LR_out, HR_out = iterator.get_next()
-
-        init_iter = iterator.make_initializer(ds)
+        if accum_steps > 1 or self.comm is not None:
+            g_train_op = self._accumulate_gradients(optimizer, model.g_loss, model.g_variables, tf.shape(x_LR)[0], 'g_accum')
+            d_train_op = self._accumulate_gradients(optimizer, model.d_loss, model.d_variables, tf.shape(x_LR)[0], 'd_accum')
+        else:
+            g_train_op = optimizer.minimize(model.g_loss, var_list=model.g_variables)
+            d_train_op = optimizer.minimize(model.d_loss, var_list=model.d_variables)
+        checkpoints = CheckpointManager(self.model_name, [('gan', 'gan', model.g_variables),
+                                                          ('gan-all', 'gan', model.g_variables+model.d_variables)], self.keep_checkpoints)
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+        g_saver = tf.train.Saver(var_list=model.g_variables)
+        gd_saver = tf.train.Saver(var_list=(model.g_variables+model.d_variables))
+
+        loss_ops = [model.g_loss, model.d_loss, model.advers_perf, model.content_loss, model.g_advers_loss]
+        metrics = MetricsLogger(self.metrics_path, self.trace_every)
         print('Done.')
 
         with tf.Session() as sess:
@@ -235,8 +334,12 @@ class PhIREGANs:
 
             print('Done.')
 
+            if self.comm is not None:
+                # All workers start from the weights of rank 0
+                self.comm.broadcast_variables(sess, model.g_variables+model.d_variables)
+
             # Start training
-            iters = 0
+            iters, g_loss = 0, None
             for epoch in range(self.epoch_shift+1, self.epoch_shift+self.N_epochs+1):
                 print('Epoch: '+str(epoch))
                 start_time = time()
@@ -244,41 +347,43 @@ class PhIREGANs:
                 # Loop through training data
                 sess.run(init_iter)
                 try:
-                    epoch_g_loss, epoch_d_loss, N = 0, 0, 0
+                    epoch_g_loss, epoch_d_loss, N, data_time, compute_time = 0, 0, 0, 0., 0.
                     while True:
-                        batch_idx, batch_LR, batch_HR = sess.run([idx, LR_out, HR_out])
-                        N_batch = batch_LR.shape[0]
-                        feed_dict = {x_HR:batch_HR, x_LR:batch_LR}
-
-                        # Initial training of the discriminator and generator
-                        sess.run(d_train_op, feed_dict=feed_dict)
-                        sess.run(g_train_op, feed_dict=feed_dict)
+                        t0 = time()
+                        N_batch, feed_dicts = self._next_batch(sess, next_batch)
+                        t1 = time()
 
-                        # Calculate current losses
-                        gl, dl, p = sess.run([model.g_loss, model.d_loss, model.advers_perf], feed_dict=feed_dict)
+                        # Initial training of the discriminator and generator, losses are computed in the same pass
+                        trace = metrics.trace_options(iters+1)
+                        self._run_step(sess, d_train_op, [], feed_dicts)
+                        gl, dl, p, g_cl, g_al = self._run_step(sess, g_train_op, loss_ops, feed_dicts, **trace)
 
                         gen_count = 1
                         while (dl < 0.460) and gen_count < 2:#30:
                             # Discriminator did too well -> train the generator extra
-                            sess.run(g_train_op, feed_dict=feed_dict)
-                            gl, dl, p = sess.run([model.g_loss, model.d_loss, model.advers_perf], feed_dict=feed_dict)
+                            gl, dl, p, g_cl, g_al = self._run_step(sess, g_train_op, loss_ops, feed_dicts)
                             gen_count += 1
 
                         dis_count = 1
                         while (dl > 0.6) and dis_count < 2:#30:
                             # Generator fooled the discriminator -> train the discriminator extra
-                            sess.run(d_train_op, feed_dict=feed_dict)
-                            gl, dl, p = sess.run([model.g_loss, model.d_loss, model.advers_perf], feed_dict=feed_dict)
+                            gl, dl, p, g_cl, g_al = self._run_step(sess, d_train_op, loss_ops, feed_dicts)
                             dis_count += 1
+                        t2 = time()
 
                         epoch_g_loss += gl*N_batch
                         epoch_d_loss += dl*N_batch
                         N += N_batch
+                        data_time += t1 - t0
+                        compute_time += t2 - t1
 
                         iters += 1
+                        metrics.log('step', 'train', epoch=epoch, iter=iters, N=N_batch, g_loss=gl, d_loss=dl,
+                                    content_loss=float(np.mean(g_cl)), advers_loss=float(np.mean(g_al)), advers_perf=p,
+                                    gen_count=gen_count, dis_count=dis_count,
+                                    data_time=t1-t0, compute_time=t2-t1, samples_per_sec=N_batch/(t2-t0))
+                        metrics.write_trace('train', iters, trace)
                         if (iters % self.print_every) == 0:
-                            g_cl, g_al = sess.run([model.content_loss, model.g_advers_loss], feed_dict=feed_dict)
-
                             print('Number of generator training steps=%d, Number of discriminator training steps=%d, ' %(gen_count, dis_count))
                             print('G loss=%.5f, Content component=%.5f, Adversarial component=%.5f' %(gl, np.mean(g_cl), np.mean(g_al)))
                             print('D loss=%.5f' %(dl))
@@ -288,50 +393,88 @@ class PhIREGANs:
                 except tf.errors.OutOfRangeError:
                     pass
 
-                if (epoch % self.save_every) == 0:                    
-                    g_model_dir  = '/'.join([self.model_name, 'gan{0:05d}'.format(epoch)])
-                    gd_model_dir = '/'.join([self.model_name, 'gan-all{0:05d}'.format(epoch)])
-                    if not os.path.exists(self.model_name):
-                        os.makedirs(self.model_name)
-                    g_saved_model  = '/'.join([g_model_dir,  'gan'])
-                    gd_saved_model = '/'.join([gd_model_dir, 'gan'])
-                    g_saver.save(sess,  g_saved_model)
-                    gd_saver.save(sess, gd_saved_model)
-
                 g_loss = epoch_g_loss/N
                 d_loss = epoch_d_loss/N
 
+                if (epoch % self.save_every) == 0 and self._is_chief():
+                    # Written in the background while the next epoch trains
+                    checkpoints.save(sess, epoch, g_loss)
+
+                epoch_time = time() - start_time
+                metrics.log('epoch', 'train', epoch=epoch, iter=iters, N=N, g_loss=g_loss, d_loss=d_loss, seconds=epoch_time,
+                            data_time=data_time, compute_time=compute_time, samples_per_sec=N/epoch_time)
+                metrics.flush()
                 print('Epoch generator training loss=%.5f, discriminator training loss=%.5f' %(g_loss, d_loss))
-                print('Epoch took %.2f seconds\n' %(time() - start_time), flush=True)
+                print('Epoch took %.2f seconds (%.2f samples/sec)\n' %(epoch_time, N/epoch_time), flush=True)
 
-            g_model_dir  ='/'.join([self.model_name, 'gan'])
-            gd_model_dir = '/'.join([self.model_name, 'gan-all'])
-            if not os.path.exists(self.model_name):
-                os.makedirs(self.model_name)
-            g_saved_model  = '/'.join([g_model_dir,  'gan'])
-            gd_saved_model = '/'.join([gd_model_dir, 'gan'])
-            g_saver.save(sess,  g_saved_model)
-            gd_saver.save(sess, gd_saved_model)
+            g_saved_model = '/'.join([self.model_name, 'gan', 'gan'])
+            if self._is_chief():
+                checkpoints.save(sess, self.epoch_shift+self.N_epochs, g_loss, final=True)
+            checkpoints.close()
+            if self.comm is not None:
+                # The final checkpoint is on disk before any worker returns its path
+                self.comm.barrier()
 
+        metrics.close()
         print('Done.')
 
         return g_saved_model
 
-    def test(self, r, data_path, model_path, batch_size=100, plot_data=False):
+    def test(self, r, data_path, model_path, batch_size=100, plot_data=False, tile_size=None, tile_halo=None,
+             plot_every=1, plot_dpi=200, plot_workers=None, output_format='npy', resume=False, flush_every=None):
         '''
             This method loads a previously trained model and runs it on test data
 
+            If tile_size is given, each LR sample is split into overlapping tiles of tile_size LR pixels
+            plus tile_halo pixels of context on each side, the tiles are super-resolved batch_size at a
+            time, and only the tile interiors are stitched into the output. Peak generator memory then
+            depends on the tile size instead of the domain size. With tile_halo >= 36 (the receptive
+            field of the generator) tiled and untiled outputs agree to float32 round-off
+            (identical on CPU); smaller halos trade accuracy near tile seams for memory.
+
+            model_path may also be a frozen generator written by export_generator (a .pb file). The
+            frozen graph takes and returns data in physical units, so mu_sig is not needed in that case.
+
+            Records may have different LR domain sizes. They are then grouped by shape, so every batch
+            holds batch_size samples of one shape, and the output must be written as a store. A
+            throughput report per shape is printed at the end.
+
+            The indices of the samples written so far are logged to progress.log in data_out_path. If a
+            run is interrupted, calling test() again with the same arguments and resume=True skips those
+            records in the data pipeline, before they are decoded, and completes the same output file.
+            Output is synced to disk and logged every flush_every batches, so at most that many batches
+            are run again after an interruption.
+
             inputs:
-                r          - (int array) should be array of prime factorization of amount of super-resolution to perform
-                data_path  - (string) path of test data file to load in
-                model_path - (string) path of model to load in
-                batch_size - (int) number of images to grab per batch. decrease if running out of memory
-                plot_data  - (bool) flag for whether or not to plot LR and SR images
+                r             - (int array) should be array of prime factorization of amount of super-resolution to perform
+                data_path     - (string or list of strings) path, glob pattern, or list of paths of test data shards
+                model_path    - (string) path of model checkpoint or frozen generator (.pb) to load in
+                batch_size    - (int) number of images to grab per batch. decrease if running out of memory
+                plot_data     - (bool) flag for whether or not to plot LR and SR images. Images are rendered in
+                                background processes while inference continues
+                tile_size     - (int) height/width of LR tile interiors. None runs whole samples through the generator
+                tile_halo     - (int) LR pixels of context around each tile, defaults to DEFAULT_TILE_HALO
+                plot_every    - (int) only plot samples whose index is a multiple of plot_every
+                plot_dpi      - (int) resolution of the plots, lower it for quick previews
+                plot_workers  - (int) number of processes rendering plots, defaults to one less than the number of cores
+                output_format - (string) 'npy' writes all samples to dataSR.npy in file order. 'store' writes a
+                                chunked store (see sr_store.py) to dataSR.store, addressable by record index
+                                and holding mu_sig, r, model_path and the channel names
+                resume        - (bool) continue an interrupted run with the same arguments and data_out_path
+                flush_every   - (int) number of batches between syncs of the output to disk, defaults to DEFAULT_FLUSH_EVERY
         '''
+        assert output_format in ['npy', 'store'], 'output_format must be npy or store'
 
         tf.reset_default_graph()
-        
-        assert self.mu_sig is not None, 'Value for mu_sig must be set first.'
+
+        frozen = model_path.endswith('.pb')
+        assert frozen or self.mu_sig is not None, 'Value for mu_sig must be set first.'
+        mu_sig = None if frozen else self.mu_sig
+
+        if flush_every is None:
+            flush_every = self.DEFAULT_FLUSH_EVERY
+        if tile_halo is None:
+            tile_halo = self.DEFAULT_TILE_HALO
         
         self.set_LR_data_shape(data_path)
         h, w, C = self.LR_data_shape
@@ -340,72 +483,503 @@ class PhIREGANs:
         
         x_LR = tf.placeholder(tf.float32, [None, None, None, C])
 
-        model = SR_NETWORK(x_LR, r=r, status='testing')
+        if frozen:
+            x_SR = import_frozen_generator(model_path, x_LR)
+        else:
+            x_SR, g_variables = build_testing_generator(x_LR, r, self.graph_cache_dir)
+            g_saver = tf.train.Saver(var_list=g_variables, max_to_keep=10000)
 
         init = tf.global_variables_initializer()
-        g_saver = tf.train.Saver(var_list=model.g_variables, max_to_keep=10000)
         print('Done.')
 
+        # Shards are read interleaved, so rows are placed by record index to keep the output
+        # in file order. Fall back to read order if indices are not unique across the shards.
+        manifest = load_manifest(data_path)
+        indices = manifest['indices']
+        bucketed = len(manifest['LR_shapes']) > 1
+        assert not bucketed or output_format == 'store', 'Records of different shapes need output_format=\'store\''
+        row_of = {i: row for row, i in enumerate(indices)}
+        if len(row_of) < len(indices):
+            row_of = None
+        assert not resume or row_of is not None, 'Cannot resume: record indices are not unique across the shards'
+
+        if not os.path.exists(self.data_out_path):
+            os.makedirs(self.data_out_path)
+        run = {'data_path': expand_data_paths(data_path), 'model_path': model_path, 'r': np.asarray(r).tolist(),
+               'mu_sig': None if frozen else np.asarray(self.mu_sig).tolist(), 'tile_size': tile_size,
+               'tile_halo': tile_halo, 'output_format': output_format}
+        progress = ProgressLog(self.data_out_path+'/progress', run, resume)
+        n_done = len(progress.done)
+        if n_done:
+            print('Skipping %d of %d samples written by the interrupted run.' %(n_done, len(indices)))
+
         print('Building data pipeline ...', end=' ')
 
-        ds = tf.data.TFRecordDataset(data_path)
-        ds = ds.map(lambda xx: self._parse_test_(xx, self.mu_sig)).batch(batch_size)
+        ds = self._record_dataset(data_path, training=False)
+        if n_done:
+            # Only the index of each record is parsed to drop the finished ones
+            done = tf.constant(sorted(progress.done), dtype=tf.int64)
+            done_table = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(done, tf.ones_like(done)), 0)
+            ds = ds.filter(lambda xx: tf.equal(done_table.lookup(
+                               tf.parse_single_example(xx, {'index': tf.FixedLenFeature([], tf.int64)})['index']), 0))
+        ds = ds.map(lambda xx: self._parse_test_(xx, mu_sig), num_parallel_calls=self.num_parallel_calls)
+        if bucketed:
+            # Batch records of the same (h, w) together, each shape fills its own batches
+            ds = ds.apply(tf.data.experimental.group_by_window(
+                    lambda idx, LR: tf.cast(tf.shape(LR)[0], tf.int64)*2**20 + tf.cast(tf.shape(LR)[1], tf.int64),
+                    lambda key, bucket: bucket.batch(batch_size), window_size=batch_size))
+        else:
+            ds = ds.batch(batch_size)
+        ds = ds.prefetch(self.prefetch)
 
         iterator = tf.data.Iterator.from_structure(ds.output_types,
                                                    ds.output_shapes)
         idx, LR_out = iterator.get_next()
 
         init_iter = iterator.make_initializer(ds)
+        init_tables = tf.tables_initializer()
         print('Done.')
 
+        plotter = SRPlotter('/'.join([self.data_out_path, 'imgs']), plot_workers, dpi=plot_dpi, every=plot_every) if plot_data else None
+        if output_format == 'store':
+            C = self.LR_data_shape[-1]
+            metadata = {'mu_sig': None if frozen else np.asarray(self.mu_sig).tolist(), 'r': np.asarray(r).tolist(),
+                        'model_path': model_path, 'data_type': self.data_type,
+                        'channel_names': CHANNEL_NAMES.get(self.data_type, ['channel_%d' %(c) for c in range(C)])}
+            writer = SRStoreWriter(self.data_out_path+'/dataSR.store', len(indices), metadata, resume=resume, flush_every=flush_every)
+        else:
+            writer = SRDataWriter(self.data_out_path+'/dataSR.npy', len(indices), resume=resume, flush_every=flush_every)
+        metrics = MetricsLogger(self.metrics_path, self.trace_every)
+
         with tf.Session() as sess:
             print('Loading saved network ...', end=' ')
-            sess.run(init)
-            g_saver.restore(sess, model_path)
+            sess.run([init, init_tables])
+            if not frozen:
+                g_saver.restore(sess, model_path)
             print('Done.')
 
             print('Running test data ...')
+            start_time = time()
+            iters, N, data_time, compute_time = 0, 0, 0., 0.
+            buckets = {}
             sess.run(init_iter)
             try:
-                data_out = None
                 while True:
-
+                    t0 = time()
                     batch_idx, batch_LR = sess.run([idx, LR_out])
                     N_batch = batch_LR.shape[0]
+                    t1 = time()
 
-                    feed_dict = {x_LR:batch_LR}
-
-                    batch_SR = sess.run(model.x_SR, feed_dict=feed_dict)
-
-                    batch_LR = self.mu_sig[1]*batch_LR + self.mu_sig[0]
-                    batch_SR = self.mu_sig[1]*batch_SR + self.mu_sig[0]
-                    if plot_data:
-                        img_path = '/'.join([self.data_out_path, 'imgs'])
-                        if not os.path.exists(img_path):
-                            os.makedirs(img_path)
-                        plot_SR_data(batch_idx, batch_LR, batch_SR, img_path)
-
-                    if data_out is None:
-                        data_out = batch_SR
+                    trace = metrics.trace_options(iters+1) if tile_size is None else {}
+                    if tile_size is None:
+                        batch_SR = sess.run(x_SR, feed_dict={x_LR:batch_LR}, **trace)
                     else:
-                        data_out = np.concatenate((data_out, batch_SR), axis=0)
+                        batch_SR = tiled_super_resolve(lambda tiles: sess.run(x_SR, feed_dict={x_LR:tiles}),
+                                                       batch_LR, np.prod(r), tile_size, tile_halo, batch_size)
+                    t2 = time()
+
+                    iters += 1
+                    N += N_batch
+                    data_time += t1 - t0
+                    compute_time += t2 - t1
+                    bucket = buckets.setdefault(batch_LR.shape[1:3], [0, 0, 0.])
+                    bucket[0], bucket[1], bucket[2] = bucket[0] + N_batch, bucket[1] + 1, bucket[2] + t2 - t1
+                    metrics.log('step', 'test', iter=iters, N=N_batch, data_time=t1-t0, compute_time=t2-t1,
+                                samples_per_sec=N_batch/(t2-t0))
+                    metrics.write_trace('test', iters, trace)
+
+                    if not frozen:
+                        batch_LR = self.mu_sig[1]*batch_LR + self.mu_sig[0]
+                        batch_SR = self.mu_sig[1]*batch_SR + self.mu_sig[0]
+                    if plotter is not None:
+                        plotter.plot(batch_idx, batch_LR, batch_SR)
+
+                    done = lambda batch_idx=batch_idx: progress.record(batch_idx)
+                    if output_format == 'store':
+                        writer.write(batch_SR, batch_idx, done)
+                    else:
+                        writer.write(batch_SR, None if row_of is None else [row_of[i] for i in batch_idx], done)
 
             except tf.errors.OutOfRangeError:
                 pass
 
-            if not os.path.exists(self.data_out_path):
-                os.makedirs(self.data_out_path)
-            np.save(self.data_out_path+'/dataSR.npy', data_out)
+            if output_format == 'store':
+                writer.close()
+            else:
+                writer.close(len(indices) - n_done)
+            progress.close()
+            if plotter is not None:
+                plotter.close()
+
+        test_time = time() - start_time
+        if bucketed:
+            print('Throughput by LR shape:')
+            for (h_b, w_b), (N_b, batches_b, seconds_b) in sorted(buckets.items()):
+                print('    %dx%d: %d samples in %d batches, %.2f samples/sec' %(h_b, w_b, N_b, batches_b, N_b/seconds_b))
+                metrics.log('bucket', 'test', h=h_b, w=w_b, N=N_b, batches=batches_b, compute_time=seconds_b,
+                            samples_per_sec=N_b/seconds_b)
+        metrics.log('test', 'test', iter=iters, N=N, seconds=test_time, data_time=data_time, compute_time=compute_time,
+                    samples_per_sec=N/test_time)
+        metrics.close()
+        print('Done.')
+
+    def export_generator(self, r, model_path, export_path=None):
+        '''
+            Export a trained generator as a frozen, constant-folded inference graph. Stride-1 transposed
+            convolutions are rewritten as the equivalent convolutions, the mu_sig normalization is folded
+            into the weights of the first layer and the de-normalization into the last layer, and nodes
+            only needed for training are stripped. The graph maps LR data in physical units (input
+            'x_LR') to SR data in physical units (output 'x_SR') and can be passed to test() as model_path.
+
+            inputs:
+                r           - (int array) should be array of prime factorization of amount of super-resolution to perform
+                model_path  - (string) path of the trained generator checkpoint
+                export_path - (string) path of the .pb file to write, defaults to <model_name>/generator.pb
+
+            output:
+                export_path - (string) path to the frozen generator
+        '''
+        from tensorflow.tools.graph_transforms import TransformGraph
+
+        tf.reset_default_graph()
+
+        assert self.mu_sig is not None, 'Value for mu_sig must be set first.'
+        mu, sigma = np.array(self.mu_sig[0], dtype=np.float32), np.array(self.mu_sig[1], dtype=np.float32)
+        C = mu.size
+
+        if export_path is None:
+            export_path = '/'.join([self.model_name, 'generator.pb'])
+
+        print('Initializing network ...', end=' ')
+        x_LR = tf.placeholder(tf.float32, [None, None, None, C], name='x_LR')
+        model = SR_NETWORK(x_LR, r=r, status='testing', deconv_as_conv=True)
+        x_SR = tf.identity(model.x_SR, name='x_SR')
+
+        g_saver = tf.train.Saver(var_list=model.g_variables, max_to_keep=10000)
+        weights = {v.op.name: v for v in model.g_variables}
+        print('Done.')
+
+        with tf.Session() as sess:
+            print('Loading saved network ...', end=' ')
+            g_saver.restore(sess, model_path)
+            print('Done.')
+
+            print('Freezing network ...', end=' ')
+            # Filters are [k, k, C_out, C_in]. x -> (x - mu)/sigma is folded into the first layer
+            W_in, b_in = sess.run([weights['generator/deconv1/weight'], weights['generator/deconv1/bias']])
+            weights['generator/deconv1/weight'].load(W_in/sigma, sess)
+            weights['generator/deconv1/bias'].load(b_in - np.sum(W_in*(mu/sigma), axis=(0, 1, 3)), sess)
+
+            # and x -> sigma*x + mu into the last layer
+            W_out, b_out = sess.run([weights['generator/deconv_out/weight'], weights['generator/deconv_out/bias']])
+            weights['generator/deconv_out/weight'].load(W_out*sigma[:, None], sess)
+            weights['generator/deconv_out/bias'].load(sigma*b_out + mu, sess)
+
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), ['x_SR'])
 
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=['x_SR'])
+        graph_def = TransformGraph(graph_def, ['x_LR'], ['x_SR'], ['strip_unused_nodes', 'fold_constants(ignore_errors=true)'])
+
+        export_dir = os.path.dirname(export_path)
+        if export_dir and not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+        with tf.gfile.GFile(export_path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
         print('Done.')
 
-    def _parse_train_(self, serialized_example, mu_sig=None):
+        return export_path
+
+    def _resume(self, model_dir, names, start_names=()):
+        '''
+            Find the checkpoint to continue training from in a model directory
+            inputs:
+                model_dir   - (string) directory of a previous run, i.e. its model_name
+                names       - (list of strings) checkpoint names to resume from, in order of preference. If one is
+                              found, epoch_shift is set to its epoch and new checkpoints are saved to model_dir
+                start_names - (list of strings) checkpoint names to start from without resuming, e.g. a pretrained
+                              generator for GAN training
+
+            outputs:
+                model_path - (string) checkpoint path to restore
+        '''
+        model_dir = model_dir.rstrip('/')
+        model_path, epoch = latest_checkpoint(model_dir, names)
+        if model_path is not None:
+            print('Resuming from %s' %(model_path))
+            self.model_name = model_dir
+            if epoch is not None:
+                self.epoch_shift = epoch
+            return model_path
+
+        model_path, _ = latest_checkpoint(model_dir, start_names)
+        assert model_path is not None, 'No checkpoint found in %s' %(model_dir)
+
+        return model_path
+
+    def _record_dataset(self, data_path, training=False, shard=None):
         '''
-            Parser data from TFRecords for the models to read in for (pre)training
+            Build a dataset of serialized records from one or more TFRecord shards. Several shards are
+            read in parallel with interleave, cycling over self.cycle_length files at a time. For training
+            the file order is shuffled every epoch and records are taken from whichever file is ready first.
+
+            With shard, every file is split by record before the files are interleaved, as if all files were
+            concatenated and dealt out to the shards in turn. The parts are disjoint, cover all records and
+            differ in size by at most one record, whatever the file order, but every worker scans all files.
+
+            inputs:
+                data_path - (string or list of strings) path, glob pattern, or list of paths of the tfrecords
+                training  - (bool) shuffle files and allow non-deterministic interleaving
+                shard     - (num_shards, index) to read only one disjoint part of the records
+
+            outputs:
+                ds - tf.data.Dataset of serialized examples
+        '''
+        files = expand_data_paths(data_path)
+        compression = tfrecord_compression(files[0])
+
+        # Index within each file of the first record of this shard
+        starts = [0]*len(files)
+        if shard is not None:
+            offsets = np.cumsum([0] + [load_manifest(f)['N'] for f in files[:-1]])
+            starts = [int((shard[1] - offset) % shard[0]) for offset in offsets]
+
+        def read_file(f, start):
+            ds = tf.data.TFRecordDataset(f, compression_type=compression)
+            if shard is not None:
+                ds = ds.shard(shard[0], start)
+            return ds
+
+        if len(files) == 1:
+            ds = read_file(files[0], starts[0])
+
+        else:
+            ds = tf.data.Dataset.from_tensor_slices((files, tf.constant(starts, dtype=tf.int64)))
+            if training:
+                ds = ds.shuffle(len(files))
+            ds = ds.apply(tf.data.experimental.parallel_interleave(
+                    read_file, cycle_length=min(self.cycle_length, len(files)), sloppy=training))
+
+        return ds
+
+    def _run_step(self, sess, train_op, fetches, feed_dicts=(None,), options=None, run_metadata=None):
+        '''
+            Run one optimization step and return fetches evaluated in the same graph execution, so
+            losses and metrics do not cost a second forward pass. The returned values are the ones
+            the update was computed from, i.e. from before the weights change.
+
+            If train_op is a set of accumulation ops from _accumulate_gradients, gradients are summed
+            over all micro-batches before a single update. Scalar fetches are then averaged over the
+            micro-batches weighted by their size, and per-sample fetches are concatenated. In
+            data-parallel training gradients and scalar fetches are also summed/averaged over workers.
+
+            inputs:
+                sess       - active tensorflow session
+                train_op   - optimizer op to run, or accumulation ops from _accumulate_gradients
+                fetches    - tensor or (nested) list of tensors to evaluate alongside the update
+                feed_dicts - feed dictionaries of the micro-batches of the step, from next_batch
+                options, run_metadata - tf.RunOptions/tf.RunMetadata to trace the step, see MetricsLogger.trace_options
+
+            outputs:
+                values of fetches
+        '''
+        if not isinstance(train_op, dict):
+            return sess.run([train_op, fetches], feed_dict=feed_dicts[0], options=options, run_metadata=run_metadata)[1]
+
+        sess.run(train_op['zero'])
+        values, weights = [], []
+        for i, feed_dict in enumerate(feed_dicts):
+            trace = {'options': options, 'run_metadata': run_metadata} if i == 0 else {}
+            N_micro, _, value = sess.run([train_op['N'], train_op['accumulate'], fetches], feed_dict=feed_dict, **trace)
+            values.append(value)
+            weights.append(N_micro)
+
+        if self.comm is not None:
+            # Sum the gradients of all workers, so every worker applies the same update
+            sums = self.comm.allreduce(sess.run(train_op['sums']))
+            sess.run(train_op['load'], feed_dict=dict(zip(train_op['feeds'], sums)))
+        sess.run(train_op['apply'])
+
+        values = self._combine_micro_batches(values, weights)
+        if self.comm is not None:
+            values = self.comm.mean(values, np.sum(weights))
+
+        return values
+
+    def _next_batch(self, sess, next_batch):
+        '''
+            Get the next batch from next_batch. In data-parallel training all workers end the epoch
+            (raise OutOfRangeError) together, as soon as one of them runs out of data. The batches the
+            workers with data left already drew are dropped, and rank 0 reports how many records they held.
+        '''
+        if self.comm is None:
+            return next_batch(sess)
+
+        try:
+            batch = next_batch(sess)
+        except tf.errors.OutOfRangeError:
+            batch = None
+
+        n_ready, n_unused = self.comm.allreduce([float(batch is not None), 0. if batch is None else float(batch[0])])
+        if n_ready < self.comm.size:
+            if self._is_chief() and n_unused > 0:
+                print('Warning: dropped %d records already drawn by workers with data left this epoch' %(n_unused))
+            raise tf.errors.OutOfRangeError(None, None, 'A worker ran out of data')
+
+        return batch
+
+    def _is_chief(self):
+        return self.comm is None or self.comm.rank == 0
+
+    def _combine_micro_batches(self, values, weights):
+        '''
+            Merge fetched values of several micro-batches: weighted mean of scalars, concatenation of arrays
+        '''
+        if isinstance(values[0], (list, tuple)):
+            return [self._combine_micro_batches(list(v), weights) for v in zip(*values)]
+        if np.ndim(values[0]) == 0:
+            return np.sum(np.multiply(values, weights))/np.sum(weights)
+
+        return np.concatenate(values, axis=0)
+
+    def _accumulate_gradients(self, optimizer, loss, var_list, N, name):
+        '''
+            Build ops that accumulate gradients over micro-batches and apply them in a single update.
+            Gradients are weighted by micro-batch size, so the update equals that of one large batch.
+
+            inputs:
+                optimizer - tf.train.Optimizer to apply the accumulated gradients with
+                loss      - loss tensor, a mean over the micro-batch
+                var_list  - variables to train
+                N         - number of samples in the micro-batch (tensor)
+                name      - (string) variable scope of the accumulators
+
+            outputs:
+                train_op - dict of ops: 'zero' resets the accumulators, 'accumulate' adds the gradients of
+                           the current micro-batch, 'apply' updates the variables, 'N' is the micro-batch size.
+                           'sums' are the accumulators, which 'load' sets from the placeholders 'feeds'
+        '''
+        N = tf.cast(N, tf.float32)
+        grads_and_vars = optimizer.compute_gradients(loss, var_list=var_list)
+
+        with tf.variable_scope(name):
+            accums = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES], name=v.op.name) for _, v in grads_and_vars]
+            count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='count')
+
+        zero = tf.group(*([tf.assign(a, tf.zeros_like(a)) for a in accums] + [tf.assign(count, 0.)]))
+        accumulate = tf.group(*([tf.assign_add(a, N*g) for a, (g, _) in zip(accums, grads_and_vars)] + [tf.assign_add(count, N)]))
+        apply = optimizer.apply_gradients([(a/count, v) for a, (_, v) in zip(accums, grads_and_vars)])
+
+        # For data-parallel training the sums are replaced by the sums over all workers before apply
+        sums = accums + [count]
+        feeds = [tf.placeholder(a.dtype.base_dtype, a.shape) for a in sums]
+        load = tf.group(*[tf.assign(a, f) for a, f in zip(sums, feeds)])
+
+        return {'zero': zero, 'accumulate': accumulate, 'apply': apply, 'N': N, 'sums': sums, 'feeds': feeds, 'load': load}
+
+    def _build_train_inputs(self, data_path, r, batch_size, feed_dict_mode=False, accum_steps=1, patch_size=None, LR_from_HR=False):
+        '''
+            Build the shuffled, parallel-parsed and prefetched training pipeline and the network inputs fed by it.
+
+            By default each batch is copied from the iterator into local variables inside the graph and
+            the network reads from those variables, so batches never pass through Python and several
+            training steps can be run on the same batch. With feed_dict_mode the network is built on
+            placeholders and each batch is fetched into NumPy and fed back in.
+
+            With accum_steps > 1 each batch holds accum_steps*batch_size samples and the network sees
+            one micro-batch of batch_size samples of it at a time, selected through the feed dictionaries.
+
+            inputs:
+                data_path      - (string or list of strings) path, glob pattern, or list of paths of training data shards
+                r              - (int array) should be array of prime factorization of amount of super-resolution to perform
+                batch_size     - (int) number of images to grab per batch
+                feed_dict_mode - (bool) feed batches through placeholders instead of staging them in the graph
+                accum_steps    - (int) number of micro-batches per batch
+                patch_size     - (int) LR size of randomly cropped training patches, None for whole samples
+                LR_from_HR     - (bool) synthesize LR data from HR data by block averaging
+
+            outputs:
+                init_iter  - op that (re)initializes the iterator at the start of an epoch
+                x_LR       - LR input tensor of the network
+                x_HR       - HR input tensor of the network
+                next_batch - function taking the session and returning (N_batch, feed_dicts) for the next batch,
+                             with one feed dictionary per micro-batch (None when batches are staged in the graph
+                             and there is a single micro-batch)
+        '''
+        h, w, C = self.LR_data_shape
+        R = np.prod(r)
+        if patch_size is not None:
+            assert patch_size <= min(h, w), 'patch_size must not exceed the LR domain size %dx%d' %(h, w)
+            h, w = patch_size, patch_size
+
+        shard = None if self.comm is None else (self.comm.size, self.comm.rank)
+        if self.global_shuffle:
+            # Records are read straight into a random order over all files, no shuffle buffer needed
+            ds = shuffled_record_dataset(data_path, shard)
+        else:
+            ds = self._record_dataset(data_path, training=True, shard=shard)
+            ds = ds.shuffle(self.shuffle_buffer)
+        ds = ds.map(lambda xx: self._parse_train_(xx, self.mu_sig, r, patch_size, LR_from_HR), num_parallel_calls=self.num_parallel_calls)
+        ds = ds.batch(batch_size*accum_steps).prefetch(self.prefetch)
+
+        iterator = tf.data.Iterator.from_structure(ds.output_types,
+                                                   ds.output_shapes)
+        idx, LR_out, HR_out = iterator.get_next()
+
+        init_iter = iterator.make_initializer(ds)
+
+        if feed_dict_mode:
+            x_LR = tf.placeholder(tf.float32, [None, h,   w,   C])
+            x_HR = tf.placeholder(tf.float32, [None, h*R, w*R, C])
+
+            def next_batch(sess):
+                batch_LR, batch_HR = sess.run([LR_out, HR_out])
+                return batch_LR.shape[0], [{x_LR:batch_LR[i:i+batch_size], x_HR:batch_HR[i:i+batch_size]}
+                                           for i in range(0, batch_LR.shape[0], batch_size)]
+
+        else:
+            LR_var = tf.Variable(tf.zeros([0, h,   w,   C]), trainable=False, validate_shape=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES], name='LR_batch')
+            HR_var = tf.Variable(tf.zeros([0, h*R, w*R, C]), trainable=False, validate_shape=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES], name='HR_batch')
+
+            load_batch = tf.group(tf.assign(LR_var, LR_out, validate_shape=False),
+                                  tf.assign(HR_var, HR_out, validate_shape=False))
+            with tf.control_dependencies([load_batch]):
+                N_out = tf.shape(idx)[0]
+
+            if accum_steps > 1:
+                micro = tf.placeholder_with_default(0, [], name='micro_batch')
+                LR_micro = LR_var.value()[micro*batch_size:(micro+1)*batch_size]
+                HR_micro = HR_var.value()[micro*batch_size:(micro+1)*batch_size]
+            else:
+                LR_micro, HR_micro = LR_var.value(), HR_var.value()
+
+            x_LR = tf.reshape(LR_micro, [-1, h,   w,   C])
+            x_HR = tf.reshape(HR_micro, [-1, h*R, w*R, C])
+
+            def next_batch(sess):
+                N_batch = sess.run(N_out)
+                if accum_steps == 1:
+                    return N_batch, [None]
+                return N_batch, [{micro:i} for i in range((N_batch + batch_size - 1)//batch_size)]
+
+        return init_iter, x_LR, x_HR, next_batch
+
+    def _parse_train_(self, serialized_example, mu_sig=None, r=None, patch_size=None, LR_from_HR=False):
+        '''
+            Parser data from TFRecords for the models to read in for (pre)training. Data stored as
+            float64, float32 or float16 (the 'dtype' field, float64 if absent) is decoded to float32.
 
             inputs:
                 serialized_example - batch of data drawn from tfrecord
                 mu_sig             - mean, standard deviation if known
+                r                  - (int array) prime factorization of the super-resolution, needed for
+                                     patch_size and LR_from_HR
+                patch_size         - (int) crop a random patch_size x patch_size LR patch and the aligned
+                                     HR patch, None to keep whole samples
+                LR_from_HR         - (bool) ignore stored LR data and average the HR data over
+                                     prod(r) x prod(r) blocks instead
 
             outputs:
                 idx     - array of indicies for each sample
@@ -414,28 +988,47 @@ class PhIREGANs:
         '''
 
         feature = {'index': tf.FixedLenFeature([], tf.int64),
-                 'data_LR': tf.FixedLenFeature([], tf.string),
-                    'h_LR': tf.FixedLenFeature([], tf.int64),
-                    'w_LR': tf.FixedLenFeature([], tf.int64),
                  'data_HR': tf.FixedLenFeature([], tf.string),
                     'h_HR': tf.FixedLenFeature([], tf.int64),
                     'w_HR': tf.FixedLenFeature([], tf.int64),
-                       'c': tf.FixedLenFeature([], tf.int64)}
+                       'c': tf.FixedLenFeature([], tf.int64),
+                   'dtype': tf.FixedLenFeature([], tf.string, default_value='float64')}
+        if not LR_from_HR:
+            feature.update({'data_LR': tf.FixedLenFeature([], tf.string),
+                               'h_LR': tf.FixedLenFeature([], tf.int64),
+                               'w_LR': tf.FixedLenFeature([], tf.int64)})
         example = tf.parse_single_example(serialized_example, feature)
 
         idx = example['index']
 
-        h_LR, w_LR = example['h_LR'], example['w_LR']
         h_HR, w_HR = example['h_HR'], example['w_HR']
 
         c = example['c']
 
-        data_LR = tf.decode_raw(example['data_LR'], tf.float64)
-        data_HR = tf.decode_raw(example['data_HR'], tf.float64)
-
-        data_LR = tf.reshape(data_LR, (h_LR, w_LR, c))
+        data_HR = decode_tfrecord_data(example['data_HR'], example['dtype'])
         data_HR = tf.reshape(data_HR, (h_HR, w_HR, c))
 
+        if LR_from_HR or patch_size is not None:
+            R = int(np.prod(r))
+
+        if not LR_from_HR:
+            data_LR = decode_tfrecord_data(example['data_LR'], example['dtype'])
+            data_LR = tf.reshape(data_LR, (example['h_LR'], example['w_LR'], c))
+            h_LR, w_LR = example['h_LR'], example['w_LR']
+        else:
+            h_LR, w_LR = h_HR//R, w_HR//R
+
+        if patch_size is not None:
+            # Random patch position on the LR grid, the HR patch covers the same area
+            i = tf.random_uniform([], 0, tf.cast(h_LR, tf.int32) - patch_size + 1, dtype=tf.int32)
+            j = tf.random_uniform([], 0, tf.cast(w_LR, tf.int32) - patch_size + 1, dtype=tf.int32)
+            data_HR = data_HR[i*R:(i+patch_size)*R, j*R:(j+patch_size)*R, :]
+            if not LR_from_HR:
+                data_LR = data_LR[i:i+patch_size, j:j+patch_size, :]
+
+        if LR_from_HR:
+            data_LR = tf.nn.avg_pool(data_HR[None], [1, R, R, 1], [1, R, R, 1], 'VALID')[0]
+
         if mu_sig is not None:
             data_LR = (data_LR - mu_sig[0])/mu_sig[1]
             data_HR = (data_HR - mu_sig[0])/mu_sig[1]
@@ -444,7 +1037,8 @@ class PhIREGANs:
 
     def _parse_test_(self, serialized_example, mu_sig=None):
         '''
-            Parser data from TFRecords for the models to read in for testing
+            Parser data from TFRecords for the models to read in for testing. Data stored as
+            float64, float32 or float16 (the 'dtype' field, float64 if absent) is decoded to float32.
 
             inputs:
                 serialized_example - batch of data drawn from tfrecord
@@ -459,7 +1053,8 @@ class PhIREGANs:
                  'data_LR': tf.FixedLenFeature([], tf.string),
                     'h_LR': tf.FixedLenFeature([], tf.int64),
                     'w_LR': tf.FixedLenFeature([], tf.int64),
-                       'c': tf.FixedLenFeature([], tf.int64)}
+                       'c': tf.FixedLenFeature([], tf.int64),
+                   'dtype': tf.FixedLenFeature([], tf.string, default_value='float64')}
         example = tf.parse_single_example(serialized_example, feature)
 
         idx = example['index']
@@ -468,7 +1063,7 @@ class PhIREGANs:
 
         c = example['c']
 
-        data_LR = tf.decode_raw(example['data_LR'], tf.float64)
+        data_LR = decode_tfrecord_data(example['data_LR'], example['dtype'])
 
         data_LR = tf.reshape(data_LR, (h_LR, w_LR, c))
 
@@ -479,62 +1074,36 @@ class PhIREGANs:
 
     def set_mu_sig(self, data_path, batch_size=1):
         '''
-            Compute mean (mu) and standard deviation (sigma) for each data channel
+            Compute mean (mu) and standard deviation (sigma) for each data channel of the HR data.
+            Statistics come from the dataset manifest, which is computed once and cached next to the data.
             inputs:
                 data_path - (string) path to the tfrecord for the training data
-                batch_size - number of samples to grab each interation
+                batch_size - unused, kept for compatibility
 
             outputs:
                 sets self.mu_sig
         '''
         print('Loading data ...', end=' ')
-        dataset = tf.data.TFRecordDataset(data_path)
-        dataset = dataset.map(self._parse_train_).batch(batch_size)
-
-        iterator = dataset.make_one_shot_iterator()
-        _, _, HR_out = iterator.get_next()
-
-        with tf.Session() as sess:
-            N, mu, sigma = 0, 0, 0
-            try:
-                while True:
-                    data_HR = sess.run(HR_out)
+        manifest = load_manifest(data_path)
 
-                    N_batch, h, w, c = data_HR.shape
-                    N_new = N + N_batch
-
-                    mu_batch = np.mean(data_HR, axis=(0, 1, 2))
-                    sigma_batch = np.var(data_HR, axis=(0, 1, 2))
-
-                    sigma = (N/N_new)*sigma + (N_batch/N_new)*sigma_batch + (N*N_batch/N_new**2)*(mu - mu_batch)**2
-                    mu = (N/N_new)*mu + (N_batch/N_new)*mu_batch
-
-                    N = N_new
-
-            except tf.errors.OutOfRangeError:
-                pass
-
-        self.mu_sig = [mu, np.sqrt(sigma)]
+        self.mu_sig = [np.array(manifest['HR_mu']), np.array(manifest['HR_sigma'])]
 
         print('Done.')
 
-    def set_LR_data_shape(self, data_path):
+    def set_LR_data_shape(self, data_path, r=None):
         '''
-            Get size and shape of LR input data
+            Get size and shape of LR input data from the dataset manifest
             inputs:
                 data_path - (string) path to the tfrecord of the data
+                r         - (int array) if given, the LR shape is that of the HR data reduced by prod(r),
+                            for LR data synthesized from HR data
 
             outputs:
                 sets self.LR_data_shape
         '''
-        print('Loading data ...', end=' ')
-        dataset = tf.data.TFRecordDataset(data_path)
-        dataset = dataset.map(self._parse_test_).batch(1)
-
-        iterator = dataset.make_one_shot_iterator()
-        _, LR_out = iterator.get_next()
-
-        with tf.Session() as sess:
-            data_LR = sess.run(LR_out)
-        
-        self.LR_data_shape = data_LR.shape[1:]
+        manifest = load_manifest(data_path)
+        if r is None:
+            self.LR_data_shape = tuple(manifest['LR_shape'])
+        else:
+            h, w, C = manifest['HR_shape']
+            self.LR_data_shape = (h//int(np.prod(r)), w//int(np.prod(r)), C)
@@ -1,43 +1,142 @@
-import tensorflow as tf 
-from io import BytesIO
-import numpy as np
+''' Convert directories of .npy arrays into sharded PhIREGANs TFRecords.
+
+    Each .npy file holds an array of shape (..., h, w, c); all leading dimensions (e.g. day, hour)
+    are flattened into samples. Samples are numbered in sorted file order and split into contiguous
+    shards that are written in parallel by a process pool. Without --lr_dir only the HR data is
+    stored, for training with LR data synthesized from HR (see PhIREGANs.pretrain/train LR_from_HR).
+
+    example:
+        python TF_record_satellite.py --lr_dir ./meteo_data/input --output ./meteo_data/train_data \
+                                      --shards 8 --workers 8 --dtype float32 --compression GZIP
+'''
+import os
 import argparse
+import numpy as np
+import tensorflow as tf
+from multiprocessing import Pool
+from utils import serialize_example, TFRECORD_DTYPES
+
+def list_arrays(lr_dir, hr_dir=None):
+    '''
+        Find the .npy files to convert and the number of samples in each
+        inputs:
+            lr_dir - (string) directory of LR .npy arrays, or None to store HR data only
+            hr_dir - (string) directory of HR .npy arrays with the same file names, or None for test data
+
+        outputs:
+            files - list of (LR path or None, HR path or None, number of samples) tuples
+    '''
+    assert lr_dir is not None or hr_dir is not None, 'At least one of lr_dir and hr_dir must be given'
+
+    files = []
+    for name in sorted(os.listdir(lr_dir if lr_dir is not None else hr_dir)):
+        if not name.endswith('.npy'):
+            continue
+        lr_path = os.path.join(lr_dir, name) if lr_dir is not None else None
+        hr_path = os.path.join(hr_dir, name) if hr_dir is not None else None
+
+        shape = np.load(lr_path if lr_path is not None else hr_path, mmap_mode='r').shape
+        if lr_path is not None and hr_path is not None:
+            assert np.load(hr_path, mmap_mode='r').shape[:-3] == shape[:-3], 'LR and HR sample counts differ for %s' %(name)
+        files.append((lr_path, hr_path, int(np.prod(shape[:-3]))))
+
+    return files
+
+def plan_shards(files, n_shards):
+    '''
+        Split the samples of all files into n_shards contiguous shards
+        inputs:
+            files    - list of (LR path, HR path, number of samples) tuples
+            n_shards - (int) number of shards
+
+        outputs:
+            shards - list with one list of (LR path, HR path, start, stop, first index) slices per shard
+    '''
+    N = sum(n for _, _, n in files)
+    bounds = np.linspace(0, N, n_shards + 1).astype(int)
+
+    shards = []
+    for s0, s1 in zip(bounds[:-1], bounds[1:]):
+        slices, offset = [], 0
+        for lr_path, hr_path, n in files:
+            start, stop = max(s0 - offset, 0), min(s1 - offset, n)
+            if start < stop:
+                slices.append((lr_path, hr_path, start, stop, offset + start))
+            offset += n
+        shards.append(slices)
+
+    return shards
+
+def write_shard(args):
+    '''
+        Write one shard of samples to a TFRecord file. Arrays are memory-mapped so only the samples
+        of this shard are read.
+    '''
+    filename, slices, dtype, compression = args
+
+    N = 0
+    options = tf.python_io.TFRecordOptions(compression) if compression else None
+    with tf.python_io.TFRecordWriter(filename, options=options) as writer:
+        for lr_path, hr_path, start, stop, idx in slices:
+            if lr_path is not None:
+                data_LR = np.load(lr_path, mmap_mode='r')
+                data_LR = data_LR.reshape((-1,) + data_LR.shape[-3:])
+            if hr_path is not None:
+                data_HR = np.load(hr_path, mmap_mode='r')
+                data_HR = data_HR.reshape((-1,) + data_HR.shape[-3:])
+
+            for i in range(start, stop):
+                writer.write(serialize_example(idx + i - start, data_LR[i] if lr_path is not None else None,
+                                               data_HR[i] if hr_path is not None else None, dtype))
+                N += 1
+
+    return filename, N
+
+def convert(lr_dir, output, hr_dir=None, n_shards=1, n_workers=1, dtype='float32', compression=''):
+    '''
+        Convert directories of .npy arrays into sharded TFRecords
+        inputs:
+            lr_dir      - (string) directory of LR .npy arrays, or None to store HR data only
+            output      - (string) output path prefix, shards are written to <output>-XXXXX-of-XXXXX.tfrecord
+            hr_dir      - (string) directory of matching HR .npy arrays, or None to write test data
+            n_shards    - (int) number of output shards
+            n_workers   - (int) number of processes writing shards
+            dtype       - (string) dtype to store the data as: 'float64', 'float32' or 'float16'
+            compression - (string) '', 'GZIP' or 'ZLIB'
+
+        outputs:
+            filenames - list of the shard paths written
+    '''
+    assert dtype in TFRECORD_DTYPES, 'dtype must be one of %s' %(list(TFRECORD_DTYPES))
+    ext = {'': '.tfrecord', 'GZIP': '.tfrecord.gz', 'ZLIB': '.tfrecord.zlib'}[compression]
+
+    files = list_arrays(lr_dir, hr_dir)
+    shards = plan_shards(files, n_shards)
+
+    out_dir = os.path.dirname(output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    jobs = [('{}-{:05d}-of-{:05d}{}'.format(output, i, n_shards, ext), slices, dtype, compression)
+            for i, slices in enumerate(shards)]
+
+    with Pool(n_workers) as pool:
+        results = pool.map(write_shard, jobs, chunksize=1)
+
+    for filename, N in results:
+        print('Wrote %d samples to %s' %(N, filename))
 
-#Path for the data to record
-file_name = ['train_data.tfrecord']
-img_path = './meteo_data'
-
-list_input = np.array([])
-count = 0
-
-#List of bytes of separated images for each day and each hour
-for pca_img in os.lisdir(os.path.join(img_path, 'input'):
-    img = np.load(os.path.join(img_path, 'input', pca_img))
-    for day in img.shape[0]:
-        for hour in img.shape[1]:
-            list_input.append(img[day][hour].flatten())
-            count+=1
-
-#Conversion to bytes and definition of features
-data_LR = list_input.tobytes()
-index = count
-c = img.shape[-1]
-h_LR = img.shape[2]
-w_LR = img.shape[3]
-
-#Definition of feature types
-feature = {
-      'c': _int64_feature(c),
-      'h_LR': _int64_feature(h_LR),
-      'w_LR ': _int64_feature(w_LR ),
-      'index': _int64_feature(index),
-      'data_LR': _bytes_feature(data_LR),
-  }
-
-#Writing of tf_record
-writer = tf.io.TFRecordWriter(file_name)
-example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
-example = example_proto.SerializeToString()
-writer.write(example)
+    return [filename for filename, _ in results]
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert .npy arrays into sharded PhIREGANs TFRecords')
+    parser.add_argument('--lr_dir', default=None, help='directory of LR .npy arrays (omit to store HR data only)')
+    parser.add_argument('--hr_dir', default=None, help='directory of matching HR .npy arrays (omit for test data)')
+    parser.add_argument('--output', required=True, help='output path prefix')
+    parser.add_argument('--shards', type=int, default=1, help='number of output shards')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of writer processes')
+    parser.add_argument('--dtype', default='float32', choices=sorted(TFRECORD_DTYPES), help='stored data type')
+    parser.add_argument('--compression', default='', choices=['', 'GZIP', 'ZLIB'], help='record compression')
+    args = parser.parse_args()
 
+    convert(args.lr_dir, args.output, args.hr_dir, args.shards, args.workers, args.dtype, args.compression)
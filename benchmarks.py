@@ -0,0 +1,290 @@
+''' Benchmark suite for the PhIREGANs generator, discriminator and end-to-end pipelines.
+
+    Synthetic TFRecords in the training schema are written for several LR domain sizes, and the suite
+    times a pretrain step, a GAN train step and test() throughput for each upscaling configuration,
+    domain size and batch size, plus the cost of each block of SR_NETWORK.generator/discriminator.
+    The pretrain step is timed both with batches staged in the graph and fed through placeholders.
+    Cold starts are timed in fresh processes: importing PhIREGANs, and a complete test() call with and
+    without a cached testing graph.
+    Results are written as JSON and, if a baseline file is given, compared against it.
+
+    example:
+        python benchmarks.py --out bench.json
+        python benchmarks.py --out bench_new.json --baseline bench.json
+'''
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+from time import time
+from PhIREGANs import PhIREGANs
+from sr_network import SR_NETWORK
+from utils import generate_TFRecords
+
+# Upscaling configurations: (name, data_type, r, mu, sigma). Wind is [ua, va], solar is [DNI, DHI]
+CONFIGS = [('wind_r2-5', 'wind',  [2, 5], [0.7684, -0.4575],    [4.9491, 5.8441]),
+           ('wind_r5',   'wind',  [5],    [0.7684, -0.4575],    [5.02455, 5.9017]),
+           ('solar_r5',  'solar', [5],    [344.3262, 113.7444], [370.8409, 111.1224])]
+
+def write_synthetic_data(path, N, h, w, r, mu, sigma, seed=0):
+    '''
+        Write N random LR/HR pairs in the _parse_train_ schema
+        inputs:
+            path      - (string) path of the tfrecord to write
+            N         - (int) number of samples
+            h, w      - (int) LR domain size
+            r         - (int array) upscaling factors, the HR domain is (h*prod(r), w*prod(r))
+            mu, sigma - per-channel mean and standard deviation of the data
+    '''
+    rng = np.random.RandomState(seed)
+    R = int(np.prod(r))
+    data_HR = mu + sigma*rng.randn(N, h*R, w*R, len(mu))
+    data_LR = data_HR.reshape(N, h, R, w, R, len(mu)).mean(axis=(2, 4))
+    generate_TFRecords(path, data_LR, data_HR, dtype='float64')
+
+def _time_steps(step, n_warmup, n_steps):
+    for _ in range(n_warmup):
+        step()
+    t_start = time()
+    for _ in range(n_steps):
+        step()
+    return (time() - t_start)/n_steps
+
+def bench_train_step(data_path, r, mu_sig, batch_size, status, n_warmup=2, n_steps=5, feed_dict_mode=False):
+    '''
+        Time one pretraining (status='pretraining') or GAN (status='training') step, built the same way
+        as PhIREGANs.pretrain/train. With feed_dict_mode batches are fed through placeholders instead of
+        being staged in the graph, see PhIREGANs._build_train_inputs
+
+        outputs:
+            seconds - (float) mean seconds per step
+    '''
+    tf.reset_default_graph()
+    phiregans = PhIREGANs(data_type='bench', mu_sig=mu_sig)
+    phiregans.set_LR_data_shape(data_path)
+
+    init_iter, x_LR, x_HR, next_batch = phiregans._build_train_inputs(data_path, r, batch_size, feed_dict_mode)
+    model = SR_NETWORK(x_LR, x_HR, r=r, status=status)
+
+    optimizer = tf.train.AdamOptimizer(learning_rate=phiregans.learning_rate)
+    g_train_op = optimizer.minimize(model.g_loss, var_list=model.g_variables)
+    if status == 'training':
+        d_train_op = optimizer.minimize(model.d_loss, var_list=model.d_variables)
+    init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+    with tf.Session() as sess:
+        sess.run(init)
+
+        def step():
+            try:
+                N_batch, feed_dicts = next_batch(sess)
+            except tf.errors.OutOfRangeError:
+                sess.run(init_iter)
+                N_batch, feed_dicts = next_batch(sess)
+            if status == 'training':
+                phiregans._run_step(sess, d_train_op, [], feed_dicts)
+                phiregans._run_step(sess, g_train_op, [model.g_loss, model.d_loss, model.advers_perf], feed_dicts)
+            else:
+                phiregans._run_step(sess, g_train_op, model.g_loss, feed_dicts)
+
+        sess.run(init_iter)
+        return _time_steps(step, n_warmup, n_steps)
+
+def save_random_generator(model_path, r, C):
+    '''
+        Save a randomly initialized generator checkpoint for inference benchmarks
+    '''
+    tf.reset_default_graph()
+    x_LR = tf.placeholder(tf.float32, [None, None, None, C])
+    model = SR_NETWORK(x_LR, r=r, status='testing')
+    g_saver = tf.train.Saver(var_list=model.g_variables)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        return g_saver.save(sess, model_path)
+
+def bench_test(data_path, model_path, r, mu_sig, batch_size, out_dir, N):
+    '''
+        Time an end-to-end PhIREGANs.test() run
+
+        outputs:
+            samples_per_sec - (float) samples/sec including graph construction and checkpoint loading
+    '''
+    phiregans = PhIREGANs(data_type='bench', mu_sig=mu_sig)
+    phiregans.set_data_out_path(out_dir)
+    t_start = time()
+    phiregans.test(r, data_path, model_path, batch_size=batch_size)
+    return N/(time() - t_start)
+
+_COLD_START_SCRIPT = '''
+import sys, json
+from time import time
+args = json.loads(sys.argv[1])
+sys.path.insert(0, args['repo_dir'])
+
+t_start = time()
+from PhIREGANs import PhIREGANs
+t_import = time()
+
+phiregans = PhIREGANs(data_type='bench', mu_sig=args['mu_sig'], graph_cache_dir=args['graph_cache_dir'])
+phiregans.set_data_out_path(args['out_dir'])
+phiregans.test(args['r'], args['data_path'], args['model_path'], batch_size=args['batch_size'])
+t_test = time()
+
+print(json.dumps({'import_seconds': t_import - t_start, 'test_seconds': t_test - t_import}))
+'''
+
+def bench_cold_start(data_path, model_path, r, mu_sig, batch_size, out_dir, graph_cache_dir=None):
+    '''
+        Time a complete short inference job in a fresh Python process
+
+        outputs:
+            times - (dict) import_seconds for importing PhIREGANs (and TensorFlow), test_seconds for the
+                    test() call, i.e. graph construction, checkpoint loading and inference
+    '''
+    args = {'repo_dir': os.path.dirname(os.path.abspath(__file__)), 'data_path': os.path.abspath(data_path),
+            'model_path': os.path.abspath(model_path), 'r': list(r), 'mu_sig': mu_sig, 'batch_size': batch_size,
+            'out_dir': os.path.abspath(out_dir), 'graph_cache_dir': graph_cache_dir and os.path.abspath(graph_cache_dir)}
+    out = subprocess.check_output([sys.executable, '-c', _COLD_START_SCRIPT, json.dumps(args)])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def bench_blocks(r, C, h, w, batch_size):
+    '''
+        Per-block cost of the generator and discriminator forward passes, from a full trace of one
+        step. Op times are summed by variable scope (e.g. generator/block_3a).
+
+        outputs:
+            costs - (dict) scope -> milliseconds
+    '''
+    tf.reset_default_graph()
+    R = int(np.prod(r))
+    x_LR = tf.placeholder(tf.float32, [None, h,   w,   C])
+    x_HR = tf.placeholder(tf.float32, [None, h*R, w*R, C])
+    model = SR_NETWORK(x_LR, x_HR, r=r, status='training')
+
+    feed_dict = {x_LR: np.random.randn(batch_size, h, w, C), x_HR: np.random.randn(batch_size, h*R, w*R, C)}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run([model.disc_HR, model.disc_SR], feed_dict=feed_dict)
+
+        run_metadata = tf.RunMetadata()
+        sess.run([model.disc_HR, model.disc_SR], feed_dict=feed_dict,
+                 options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+
+    costs = {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node in dev_stats.node_stats:
+            scope = node.node_name.split(':')[0].split('/')
+            if scope[0] in ['generator', 'discriminator'] and len(scope) > 2:
+                key = '/'.join(scope[:2])
+                costs[key] = costs.get(key, 0) + node.all_end_rel_micros/1000
+
+    return costs
+
+def run_benchmarks(out_path, domain_sizes=(10, 20), batch_sizes=(1, 4), N=8, n_steps=5, work_dir=None):
+    '''
+        Run the full benchmark suite
+        inputs:
+            out_path     - (string) JSON file to write results to
+            domain_sizes - (int array) LR domain sizes (h = w) to benchmark
+            batch_sizes  - (int array) batch sizes to benchmark
+            N            - (int) number of synthetic samples per dataset
+            n_steps      - (int) number of timed training steps per case
+            work_dir     - (string) directory for synthetic data and checkpoints, a temporary one if None
+
+        outputs:
+            results - list of result records
+    '''
+    cleanup = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='phiregans_bench_')
+
+    results = []
+    def record(case, config, h, batch_size, metric, value):
+        results.append({'case': case, 'config': config, 'h': h, 'batch_size': batch_size, 'metric': metric, 'value': value})
+        print('%-12s %-10s h=%-4d batch=%-3d %s=%.4f' %(case, config, h, batch_size, metric, value), flush=True)
+
+    try:
+        for name, data_type, r, mu, sigma in CONFIGS:
+            mu_sig = [mu, sigma]
+            os.makedirs('/'.join([work_dir, name, 'model']))
+            model_path = save_random_generator('/'.join([work_dir, name, 'model', 'gen']), r, len(mu))
+
+            for h in domain_sizes:
+                data_path = '/'.join([work_dir, name, 'data_{}.tfrecord'.format(h)])
+                write_synthetic_data(data_path, N, h, h, r, mu, sigma)
+
+                for batch_size in batch_sizes:
+                    t = bench_train_step(data_path, r, mu_sig, batch_size, 'pretraining', n_steps=n_steps)
+                    record('pretrain', name, h, batch_size, 'samples_per_sec', batch_size/t)
+
+                    t = bench_train_step(data_path, r, mu_sig, batch_size, 'pretraining', n_steps=n_steps, feed_dict_mode=True)
+                    record('pretrain_feed', name, h, batch_size, 'samples_per_sec', batch_size/t)
+
+                    t = bench_train_step(data_path, r, mu_sig, batch_size, 'training', n_steps=n_steps)
+                    record('train', name, h, batch_size, 'samples_per_sec', batch_size/t)
+
+                    out_dir = '/'.join([work_dir, name, 'out'])
+                    record('test', name, h, batch_size, 'samples_per_sec', bench_test(data_path, model_path, r, mu_sig, batch_size, out_dir, N))
+
+                for scope, ms in sorted(bench_blocks(r, len(mu), h, h, batch_sizes[-1]).items()):
+                    record('block', name, h, batch_sizes[-1], scope+'_ms', ms)
+
+                # Cold starts, the cached graph is written by the first cached run and reused by the second
+                out_dir = '/'.join([work_dir, name, 'out'])
+                graph_cache_dir = '/'.join([work_dir, 'graph_cache'])
+                times = bench_cold_start(data_path, model_path, r, mu_sig, batch_sizes[-1], out_dir)
+                record('cold_start', name, h, batch_sizes[-1], 'import_seconds', times['import_seconds'])
+                record('cold_start', name, h, batch_sizes[-1], 'test_seconds', times['test_seconds'])
+                bench_cold_start(data_path, model_path, r, mu_sig, batch_sizes[-1], out_dir, graph_cache_dir)
+                times = bench_cold_start(data_path, model_path, r, mu_sig, batch_sizes[-1], out_dir, graph_cache_dir)
+                record('cold_start', name, h, batch_sizes[-1], 'test_seconds_graph_cache', times['test_seconds'])
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    return results
+
+def compare(results, baseline):
+    '''
+        Compare results against a baseline run. Ratios above 1 are improvements: for samples/sec
+        metrics this is new/old, for time metrics old/new.
+
+        outputs:
+            comparison - list of (key, old value, new value, ratio) tuples
+    '''
+    key = lambda rec: (rec['case'], rec['config'], rec['h'], rec['batch_size'], rec['metric'])
+    old = {key(rec): rec['value'] for rec in baseline}
+
+    comparison = []
+    for rec in results:
+        k = key(rec)
+        if k in old and old[k] > 0 and rec['value'] > 0:
+            ratio = rec['value']/old[k] if k[-1] == 'samples_per_sec' else old[k]/rec['value']
+            comparison.append((k, old[k], rec['value'], ratio))
+            print('%-70s %10.4f -> %10.4f  (x%.2f)' %(' '.join(map(str, k)), old[k], rec['value'], ratio))
+
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PhIREGANs training and inference')
+    parser.add_argument('--out', default='bench.json', help='JSON file to write results to')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare against')
+    parser.add_argument('--domain_sizes', type=int, nargs='+', default=[10, 20])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--N', type=int, default=8, help='synthetic samples per dataset')
+    parser.add_argument('--steps', type=int, default=5, help='timed training steps per case')
+    parser.add_argument('--work_dir', default=None, help='keep synthetic data and checkpoints here')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.out, args.domain_sizes, args.batch_sizes, args.N, args.steps, args.work_dir)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
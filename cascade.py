@@ -0,0 +1,193 @@
+''' Cascaded inference through several generators in one pass, e.g. wind LR -> MR (r=[2, 5]) -> HR (r=[5]).
+
+    Every stage is an SRGenerator in its own graph and session, mapping data in physical units to data
+    in physical units, so each stage re-normalizes its input with its own mu_sig and the output of one
+    stage is fed directly to the next without going through disk. Stages run in their own threads,
+    connected by bounded queues, so while stage 2 works on one batch stage 1 already works on the next.
+
+    example:
+        python cascade.py --data_path example_data/wind_LR-MR.tfrecord --data_out_path data_out/wind_cascade --data_type wind \
+                          --stages '[{"r": [2, 5], "model_path": "models/wind_lr-mr/trained_gan/gan", "mu_sig": [[0.7684, -0.4575], [4.9491, 5.8441]]},
+                                     {"r": [5], "model_path": "models/wind_mr-hr/trained_gan/gan", "mu_sig": [[0.7684, -0.4575], [5.02455, 5.9017]]}]'
+'''
+import os
+import json
+import queue
+import argparse
+import threading
+import numpy as np
+import tensorflow as tf
+from time import time
+from manifest import load_manifest
+from PhIREGANs import PhIREGANs
+from sr_server import SRGenerator
+from sr_store import SRStoreWriter, CHANNEL_NAMES
+from utils import SRDataWriter
+
+class Cascade(object):
+    '''
+        A chain of generators, each taking the output of the previous one
+    '''
+    def __init__(self, stages, config=None, max_queue=2):
+        '''
+            inputs:
+                stages    - list of (r, model_path, mu_sig) tuples in the order they are applied. mu_sig may be
+                            None for frozen generators
+                config    - (tf.ConfigProto) session configuration of every stage
+                max_queue - (int) number of batches that may wait between two stages
+        '''
+        self.generators = [SRGenerator(r, model_path, mu_sig, config=config) for r, model_path, mu_sig in stages]
+        self.max_queue = max_queue
+
+    def __call__(self, LR):
+        '''
+            Run one batch through all stages
+            inputs:
+                LR - (N, h, w, C) array in physical units
+
+            outputs:
+                SR - (N, R*h, R*w, C) array in physical units, R being the product of all stages' factors
+        '''
+        for generator in self.generators:
+            LR = generator(LR)
+        return LR
+
+    def run(self, batches):
+        '''
+            Run batches through the stages, with each stage in its own thread
+            inputs:
+                batches - iterable of (key, LR) pairs, e.g. record indices and LR data
+
+            outputs:
+                generator of (key, SR) pairs, in the order of batches
+        '''
+        queues = [queue.Queue(maxsize=self.max_queue) for _ in range(len(self.generators) + 1)]
+
+        def feed():
+            try:
+                for item in batches:
+                    queues[0].put(item)
+            except Exception as e:
+                queues[0].put(e)
+            queues[0].put(None)
+
+        def stage(generator, q_in, q_out):
+            while True:
+                item = q_in.get()
+                if item is not None and not isinstance(item, Exception):
+                    try:
+                        item = (item[0], generator(item[1]))
+                    except Exception as e:
+                        item = e
+                q_out.put(item)
+                if item is None:
+                    break
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads += [threading.Thread(target=stage, args=(generator, queues[i], queues[i+1]), daemon=True)
+                    for i, generator in enumerate(self.generators)]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = queues[-1].get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        for generator in self.generators:
+            generator.close()
+
+def _read_batches(data_path, batch_size):
+    '''
+        Batches of (record indices, LR data in physical units) from test or training TFRecords
+    '''
+    phiregans = PhIREGANs(data_type='cascade')
+    with tf.Graph().as_default():
+        ds = phiregans._record_dataset(data_path, training=False)
+        ds = ds.map(lambda xx: phiregans._parse_test_(xx, None), num_parallel_calls=phiregans.num_parallel_calls)
+        ds = ds.batch(batch_size).prefetch(phiregans.prefetch)
+        idx, LR_out = ds.make_one_shot_iterator().get_next()
+
+        with tf.Session() as sess:
+            try:
+                while True:
+                    yield sess.run([idx, LR_out])
+            except tf.errors.OutOfRangeError:
+                pass
+
+def cascade_test(stages, data_path, data_out_path, batch_size=1, output_format='npy', data_type=None, config=None):
+    '''
+        Super-resolve TFRecords through all stages and write the final output, like PhIREGANs.test
+        inputs:
+            stages        - list of (r, model_path, mu_sig) tuples, see Cascade
+            data_path     - (string or list of strings) path, glob pattern, or list of paths of the LR tfrecords
+            data_out_path - (string) directory to write dataSR.npy or dataSR.store to
+            batch_size    - (int) number of samples per batch
+            output_format - (string) 'npy' or 'store', see PhIREGANs.test
+            data_type     - (string) 'wind' or 'solar', names the channels in the store
+            config        - (tf.ConfigProto) session configuration of every stage
+
+        outputs:
+            samples_per_sec - (float) throughput of the whole cascade
+    '''
+    assert output_format in ['npy', 'store'], 'output_format must be npy or store'
+
+    indices = load_manifest(data_path)['indices']
+    row_of = {i: row for row, i in enumerate(indices)}
+    if len(row_of) < len(indices):
+        row_of = None
+
+    if not os.path.exists(data_out_path):
+        os.makedirs(data_out_path)
+
+    print('Loading %d generators ...' %(len(stages)), end=' ')
+    cascade = Cascade(stages, config=config)
+    print('Done.')
+
+    if output_format == 'store':
+        C = load_manifest(data_path)['LR_shape'][-1]
+        metadata = {'stages': [{'r': np.asarray(r).tolist(), 'model_path': model_path,
+                                'mu_sig': None if mu_sig is None else np.asarray(mu_sig).tolist()} for r, model_path, mu_sig in stages],
+                    'r': [int(f) for r, _, _ in stages for f in r], 'data_type': data_type,
+                    'channel_names': CHANNEL_NAMES.get(data_type, ['channel_%d' %(c) for c in range(C)])}
+        writer = SRStoreWriter(data_out_path+'/dataSR.store', len(indices), metadata)
+    else:
+        writer = SRDataWriter(data_out_path+'/dataSR.npy', len(indices))
+
+    print('Running cascade ...', end=' ')
+    start_time, N = time(), 0
+    for batch_idx, batch_SR in cascade.run(_read_batches(data_path, batch_size)):
+        if output_format == 'store':
+            writer.write(batch_SR, batch_idx)
+        else:
+            writer.write(batch_SR, None if row_of is None else [row_of[i] for i in batch_idx])
+        N += len(batch_idx)
+
+    writer.close()
+    cascade.close()
+    seconds = time() - start_time
+    print('Done.')
+    print('Super-resolved %d samples in %.2f seconds (%.2f samples/sec)' %(N, seconds, N/seconds))
+
+    return N/seconds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several PhIREGANs generators as a cascade')
+    parser.add_argument('--stages', type=json.loads, required=True,
+                        help='JSON list of {"r": [...], "model_path": ..., "mu_sig": [[mu...], [sigma...]]} in order')
+    parser.add_argument('--data_path', nargs='+', required=True, help='LR data paths or glob patterns')
+    parser.add_argument('--data_out_path', required=True)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--output_format', default='npy', choices=['npy', 'store'])
+    parser.add_argument('--data_type', default=None, help='wind or solar, names the channels in the store')
+    args = parser.parse_args()
+
+    stages = [(stage['r'], stage['model_path'], stage.get('mu_sig')) for stage in args.stages]
+    cascade_test(stages, args.data_path, args.data_out_path, args.batch_size, args.output_format, args.data_type)
@@ -0,0 +1,170 @@
+''' Asynchronous checkpointing with a retention policy, and checkpoint discovery for resuming training.
+
+    Saving copies the variables into shadow variables with a single in-graph op and then writes the
+    shadow copies from a background thread, so training continues while the checkpoint is written and
+    the checkpoint still holds the weights of one consistent step. Checkpoints are written under the
+    original variable names and directory layout (e.g. <model_name>/gan00010/gan), so they restore with
+    the usual savers.
+
+    Every checkpoint is recorded in <model_name>/checkpoints.json with its epoch and training loss.
+    Only the keep_last most recent epoch checkpoints and the one with the lowest loss are kept on
+    disk, separately for every set of checkpoints (e.g. 'cnn' from pretraining and 'gan'/'gan-all' from
+    training); final checkpoints (e.g. <model_name>/gan/gan) are never removed.
+'''
+import os
+import re
+import json
+import shutil
+import threading
+import tensorflow as tf
+
+STATE_FILE = 'checkpoints.json'
+
+def _load_state(model_dir):
+    path = '/'.join([model_dir, STATE_FILE])
+    if not os.path.exists(path):
+        return {'checkpoints': []}
+    with open(path) as f:
+        return json.load(f)
+
+def latest_checkpoint(model_dir, names):
+    '''
+        Find the most recent checkpoint in a model directory
+        inputs:
+            model_dir - (string) directory checkpoints were saved to, i.e. a previous model_name
+            names     - (list of strings) checkpoint names in order of preference, e.g. ['gan-all', 'gan']
+
+        outputs:
+            path  - (string) checkpoint path for Saver.restore, None if no checkpoint was found
+            epoch - (int) epoch the checkpoint was saved at, None if unknown
+    '''
+    entries = sorted(_load_state(model_dir)['checkpoints'], key=lambda e: (e['epoch'], e['final']))
+    for name in names:
+        for entry in reversed(entries):
+            if name in entry['paths'] and os.path.exists(entry['paths'][name] + '.index'):
+                return entry['paths'][name], entry['epoch']
+
+    # Directories written before checkpoints were recorded: <name>NNNNN/ per epoch and <name>/ at the end
+    for name in names:
+        epochs = sorted([int(d[len(name):]) for d in os.listdir(model_dir) if re.match(re.escape(name) + r'\d{5}$', d)], reverse=True)
+        for d, epoch in [(name + '{0:05d}'.format(e), e) for e in epochs] + [(name, None)]:
+            path = tf.train.latest_checkpoint('/'.join([model_dir, d])) if os.path.isdir('/'.join([model_dir, d])) else None
+            if path is not None:
+                return path, epoch
+
+    return None, None
+
+class CheckpointManager(object):
+    '''
+        Writes checkpoints of one or more variable sets in a background thread and prunes old ones
+    '''
+    def __init__(self, model_name, checkpoints, keep_last=None):
+        '''
+            Must be created before the local variable initializer is built, as the shadow copies are local variables.
+
+            inputs:
+                model_name  - (string) directory to save checkpoints to
+                checkpoints - list of (name, file name, variables) tuples, e.g. [('gan', 'gan', g_vars)].
+                              Epoch checkpoints go to <model_name>/<name>NNNNN/<file name>, final ones to
+                              <model_name>/<name>/<file name>
+                keep_last   - (int) number of most recent epoch checkpoints to keep besides the best one, None keeps all
+        '''
+        self.model_name, self.keep_last = model_name, keep_last
+
+        variables = []
+        for _, _, var_list in checkpoints:
+            variables += [v for v in var_list if v not in variables]
+
+        with tf.name_scope('checkpoint_shadow'):
+            shadow = {v: tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES], name=v.op.name) for v in variables}
+            self.snapshot = tf.group(*[tf.assign(shadow[v], v) for v in variables])
+
+        self.savers = [(name, file_name, tf.train.Saver(var_list={v.op.name: shadow[v] for v in var_list}, max_to_keep=None))
+                       for name, file_name, var_list in checkpoints]
+
+        self.thread, self.error = None, None
+
+    def save(self, sess, epoch, loss=None, final=False):
+        '''
+            Snapshot the variables and write them in the background. Waits for the previous save first.
+            inputs:
+                sess  - active tensorflow session
+                epoch - (int) current epoch
+                loss  - (float) training loss of the epoch, used to keep the best checkpoint
+                final - (bool) write the final, unnumbered checkpoint, which is never pruned
+
+            outputs:
+                paths - (dict) checkpoint name -> checkpoint path
+        '''
+        self.wait()
+        sess.run(self.snapshot)
+
+        paths = {}
+        for name, file_name, _ in self.savers:
+            model_dir = '/'.join([self.model_name, name if final else name + '{0:05d}'.format(epoch)])
+            paths[name] = '/'.join([model_dir, file_name])
+
+        self.thread = threading.Thread(target=self._write, args=(sess, epoch, loss, final, paths))
+        self.thread.start()
+
+        return paths
+
+    def wait(self):
+        '''
+            Block until the checkpoint being written is on disk
+        '''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+
+    def _write(self, sess, epoch, loss, final, paths):
+        try:
+            for name, _, saver in self.savers:
+                model_dir = os.path.dirname(paths[name])
+                if not os.path.exists(model_dir):
+                    os.makedirs(model_dir)
+                saver.save(sess, paths[name])
+
+            state = _load_state(self.model_name)
+            state['checkpoints'] = [e for e in state['checkpoints'] if e['paths'] != paths]
+            state['checkpoints'].append({'epoch': epoch, 'loss': None if loss is None else float(loss), 'final': final, 'paths': paths})
+            self._prune(state)
+
+            tmp_path = '/'.join([self.model_name, STATE_FILE + '.tmp'])
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, '/'.join([self.model_name, STATE_FILE]))
+
+        except Exception as e:
+            self.error = e
+
+    def _prune(self, state):
+        '''
+            Remove epoch checkpoints that are neither among the keep_last most recent nor the best by loss.
+            Only checkpoints of this manager's set are compared, e.g. a pretraining run's 'cnn' checkpoints
+            are left alone by the 'gan'/'gan-all' manager of a later run on the same model_name, as their
+            epochs and losses are not comparable.
+        '''
+        if self.keep_last is None:
+            return
+
+        names = sorted(name for name, _, _ in self.savers)
+        entries = sorted([e for e in state['checkpoints'] if not e['final'] and sorted(e['paths']) == names],
+                         key=lambda e: e['epoch'])
+        keep = entries[-self.keep_last:] if self.keep_last > 0 else []
+        scored = [e for e in entries if e['loss'] is not None]
+        if scored:
+            keep.append(min(scored, key=lambda e: e['loss']))
+
+        for entry in entries:
+            if entry not in keep:
+                for path in entry['paths'].values():
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                state['checkpoints'].remove(entry)
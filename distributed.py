@@ -0,0 +1,253 @@
+''' Data-parallel training of PhIREGANs across processes and nodes.
+
+    Each worker reads a disjoint shard of the training TFRecords (every size-th record of all files, so
+    shards differ by at most one record) and computes gradients on its own batches. Before every
+    update of the generator or discriminator the gradients of all workers are summed, weighted by
+    their batch sizes, so all workers apply the same update and stay in sync. Losses are averaged across
+    workers as well, so the adaptive G/D balancing in train() takes the same decisions everywhere.
+    Workers start from rank 0's weights and only rank 0 writes checkpoints.
+
+    Workers talk to rank 0 over multiprocessing.connection (TCP), which sums the gradients and sends
+    the result back. On one machine, launch() starts and pins the workers; across nodes, start one
+    process per node with --rank and the address of rank 0.
+
+    example:
+        python distributed.py --workers 4 --method pretrain --r 2 5 --data_path 'example_data/wind_LR-MR-*.tfrecord' \
+                              --mu_sig '[[0.7684, -0.4575], [4.9491, 5.8441]]' --model_name models/wind_dp --batch_size 4
+
+        # node 0 of 2, then node 1
+        python distributed.py --rank 0 --size 2 --address node0:29500 --method pretrain ...
+        python distributed.py --rank 1 --size 2 --address node0:29500 --method pretrain ...
+'''
+import os
+import json
+import argparse
+import threading
+import numpy as np
+import multiprocessing as mp
+from time import time, sleep
+from multiprocessing.connection import Listener, Client
+
+class Communicator(object):
+    '''
+        Collective operations between training workers, through a hub on rank 0
+    '''
+    def __init__(self, rank, size, address=('127.0.0.1', 29500), authkey=b'phiregans', timeout=60):
+        '''
+            inputs:
+                rank    - (int) index of this worker, 0 to size-1
+                size    - (int) number of workers
+                address - (host, port) that rank 0 listens on
+                authkey - (bytes) shared key authenticating the workers
+                timeout - (float) seconds to keep retrying the connection to rank 0, and that rank 0 waits for
+                          all workers to connect
+        '''
+        self.rank, self.size = rank, size
+        self.conns = []
+
+        if size == 1:
+            return
+
+        if rank == 0:
+            listener = Listener(tuple(address), authkey=authkey)
+            conns = {}
+            def accept():
+                while len(conns) < size - 1:
+                    conn = listener.accept()
+                    conns[conn.recv()] = conn
+
+            # accept() has no timeout, so wait for it in a thread to not hang on a worker that never starts
+            thread = threading.Thread(target=accept, daemon=True)
+            thread.start()
+            thread.join(timeout)
+            missing = sorted(set(range(1, size)) - set(conns))
+            assert not missing, 'Workers %s did not connect to rank 0 within %d seconds' %(missing, timeout)
+            listener.close()
+            self.conns = [conns[i] for i in range(1, size)]
+
+        else:
+            t_start = time()
+            while True:
+                try:
+                    conn = Client(tuple(address), authkey=authkey)
+                    break
+                except (ConnectionRefusedError, OSError):
+                    assert time() - t_start < timeout, 'Could not connect to rank 0 at %s:%d' %(tuple(address))
+                    sleep(0.1)
+            conn.send(rank)
+            self.conns = [conn]
+
+    def allreduce(self, arrays):
+        '''
+            Sum a list of arrays over all workers. Every worker gets the same result.
+        '''
+        if self.size == 1:
+            return arrays
+
+        if self.rank == 0:
+            total = [np.array(a, dtype=np.float64 if np.ndim(a) == 0 else None, copy=True) for a in arrays]
+            for conn in self.conns:
+                for t, a in zip(total, conn.recv()):
+                    t += a
+            for conn in self.conns:
+                conn.send(total)
+            return total
+
+        self.conns[0].send(arrays)
+        return self.conns[0].recv()
+
+    def broadcast(self, obj):
+        '''
+            Send obj from rank 0 to all workers and return it
+        '''
+        if self.size == 1:
+            return obj
+
+        if self.rank == 0:
+            for conn in self.conns:
+                conn.send(obj)
+            return obj
+
+        return self.conns[0].recv()
+
+    def mean(self, values, weight):
+        '''
+            Weighted mean over workers of the scalars in a (nested) list of fetched values. Arrays
+            such as per-sample losses are left as the local values.
+        '''
+        scalars = []
+        def collect(v):
+            if isinstance(v, (list, tuple)):
+                for x in v:
+                    collect(x)
+            elif np.ndim(v) == 0:
+                scalars.append(weight*v)
+        collect(values)
+
+        if not scalars:
+            return values
+        total = self.allreduce(scalars + [weight])
+        means = iter([s/total[-1] for s in total[:-1]])
+
+        def rebuild(v):
+            if isinstance(v, (list, tuple)):
+                return [rebuild(x) for x in v]
+            return next(means) if np.ndim(v) == 0 else v
+
+        return rebuild(values)
+
+    def broadcast_variables(self, sess, variables):
+        '''
+            Set variables on all workers to their values on rank 0
+        '''
+        values = self.broadcast(sess.run(variables) if self.rank == 0 else None)
+        if self.rank != 0:
+            for v, value in zip(variables, values):
+                v.load(value, sess)
+
+    def barrier(self):
+        self.allreduce([0.])
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+
+def run_worker(rank, size, address, method, init_kwargs, call_kwargs, cores=None):
+    '''
+        Run PhIREGANs.<method> as one worker of a data-parallel job
+        inputs:
+            rank, size, address - see Communicator
+            method      - (string) 'pretrain' or 'train'
+            init_kwargs - (dict) arguments for PhIREGANs(). model_name, if given, must be shared by all workers
+            call_kwargs - (dict) arguments for the method
+            cores       - (list of ints) CPU cores to pin the worker to
+
+        outputs:
+            path to the trained model (written by rank 0)
+    '''
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    from PhIREGANs import PhIREGANs
+
+    init_kwargs = dict(init_kwargs)
+    model_name = init_kwargs.pop('model_name', None)
+    if rank != 0:
+        init_kwargs['metrics_path'] = None
+
+    phiregans = PhIREGANs(**init_kwargs)
+    if model_name is not None:
+        phiregans.setModel_name(model_name)
+
+    comm = Communicator(rank, size, address)
+    phiregans.setCommunicator(comm)
+    try:
+        return getattr(phiregans, method)(**call_kwargs)
+    finally:
+        comm.close()
+
+def _launch_worker(args):
+    return run_worker(*args)
+
+def launch(n_workers, method, init_kwargs, call_kwargs, address=('127.0.0.1', 29500), cores_per_worker=None):
+    '''
+        Run a data-parallel job with n_workers local processes
+        inputs:
+            n_workers        - (int) number of worker processes
+            method           - (string) 'pretrain' or 'train'
+            init_kwargs      - (dict) arguments for PhIREGANs(), should include model_name
+            call_kwargs      - (dict) arguments for the method, batch_size is per worker
+            address          - (host, port) for the workers to communicate on
+            cores_per_worker - (int) cores pinned to each worker, defaults to an even split of the machine
+
+        outputs:
+            saved_model - (string) path to the trained model
+            seconds     - (float) wall time of the job
+    '''
+    n_cpus = os.cpu_count()
+    if cores_per_worker is None:
+        cores_per_worker = max(n_cpus//n_workers, 1)
+    jobs = [(rank, n_workers, address, method, init_kwargs, call_kwargs,
+             [c % n_cpus for c in range(rank*cores_per_worker, (rank+1)*cores_per_worker)])
+            for rank in range(n_workers)]
+
+    t_start = time()
+    with mp.get_context('spawn').Pool(n_workers) as pool:
+        results = pool.map(_launch_worker, jobs, chunksize=1)
+
+    return results[0], time() - t_start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel PhIREGANs training')
+    parser.add_argument('--method', default='pretrain', choices=['pretrain', 'train'])
+    parser.add_argument('--workers', type=int, default=2, help='number of local worker processes')
+    parser.add_argument('--rank', type=int, default=None, help='run a single worker of a multi-node job with this rank')
+    parser.add_argument('--size', type=int, default=None, help='number of workers in a multi-node job')
+    parser.add_argument('--address', default='127.0.0.1:29500', help='host:port of rank 0')
+    parser.add_argument('--r', type=int, nargs='+', required=True, help='prime factorization of the super-resolution')
+    parser.add_argument('--data_path', nargs='+', required=True, help='training data paths or glob patterns')
+    parser.add_argument('--model_path', default=None, help='model to start from (required for train)')
+    parser.add_argument('--model_name', required=True, help='directory rank 0 saves checkpoints to')
+    parser.add_argument('--data_type', default='wind')
+    parser.add_argument('--mu_sig', type=json.loads, default=None, help='JSON [[mu...], [sigma...]]')
+    parser.add_argument('--N_epochs', type=int, default=None)
+    parser.add_argument('--batch_size', type=int, default=1, help='batch size per worker')
+    parser.add_argument('--accum_steps', type=int, default=1)
+    parser.add_argument('--patch_size', type=int, default=None, help='LR size of random training patches')
+    parser.add_argument('--LR_from_HR', action='store_true', help='synthesize LR data from HR-only records')
+    parser.add_argument('--global_shuffle', action='store_true', help='read records in a globally shuffled order via an offset index')
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(':', 1)
+    init_kwargs = {'data_type': args.data_type, 'mu_sig': args.mu_sig, 'N_epochs': args.N_epochs, 'model_name': args.model_name,
+                   'global_shuffle': args.global_shuffle}
+    call_kwargs = {'r': args.r, 'data_path': args.data_path, 'model_path': args.model_path,
+                   'batch_size': args.batch_size, 'accum_steps': args.accum_steps,
+                   'patch_size': args.patch_size, 'LR_from_HR': args.LR_from_HR}
+
+    if args.rank is not None:
+        print(run_worker(args.rank, args.size, (host, int(port)), args.method, init_kwargs, call_kwargs))
+    else:
+        saved_model, seconds = launch(args.workers, args.method, init_kwargs, call_kwargs, (host, int(port)))
+        print('Trained %s with %d workers in %.2f seconds' %(saved_model, args.workers, seconds))
@@ -0,0 +1,163 @@
+''' @author: Andrew Glaws, Karen Stengel, Ryan King
+'''
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from utils import tfrecord_compression, expand_data_paths
+
+MANIFEST_VERSION = 2
+
+def manifest_path(data_path):
+    return data_path + '.manifest.json'
+
+def load_manifest(data_path):
+    '''
+        Load the manifest of a TFRecord file, building it with a single pass over the data if no
+        up-to-date sidecar exists. The sidecar is keyed by the file path, size and modification time
+        so it is rebuilt whenever the data changes. For several shards the per-file manifests are merged.
+
+        inputs:
+            data_path - (string or list of strings) path, glob pattern, or list of paths to the tfrecords
+
+        outputs:
+            manifest - (dict) record count, indices, shapes, dtype and per-channel statistics
+    '''
+    files = expand_data_paths(data_path)
+    if len(files) > 1:
+        return merge_manifests([load_manifest(f) for f in files])
+    data_path = files[0]
+
+    stat = os.stat(data_path)
+    key = {'path': os.path.abspath(data_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    sidecar = manifest_path(data_path)
+    if os.path.exists(sidecar):
+        try:
+            with open(sidecar) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('key') == key:
+                return manifest
+        except ValueError:
+            pass
+
+    print('Building manifest for %s ...' %(data_path), end=' ')
+    manifest = build_manifest(data_path)
+    manifest['key'] = key
+
+    try:
+        tmp_path = sidecar + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        print('Could not write manifest (%s) ...' %(e), end=' ')
+    print('Done.')
+
+    return manifest
+
+def build_manifest(data_path):
+    '''
+        Scan a TFRecord file once and compute its record count, record indices, LR/HR shapes, dtype
+        and per-channel mean/standard deviation of the LR and HR data. LR_shape is the shape of the
+        first record, LR_shapes lists all distinct LR shapes.
+
+        inputs:
+            data_path - (string) path to the tfrecord
+
+        outputs:
+            manifest - (dict) manifest without the sidecar key
+    '''
+    N, indices = 0, []
+    LR_shape, HR_shape, dtype = None, None, None
+    LR_shapes = []
+    LR_stats, HR_stats = [0, 0, 0], [0, 0, 0]
+
+    compression = tfrecord_compression(data_path)
+    options = tf.python_io.TFRecordOptions(compression) if compression else None
+    for record in tf.python_io.tf_record_iterator(data_path, options=options):
+        feature = tf.train.Example.FromString(record).features.feature
+        indices.append(feature['index'].int64_list.value[0])
+        c = feature['c'].int64_list.value[0]
+        dtype = feature['dtype'].bytes_list.value[0].decode() if 'dtype' in feature else 'float64'
+
+        if 'data_LR' in feature:
+            h, w = feature['h_LR'].int64_list.value[0], feature['w_LR'].int64_list.value[0]
+            data_LR = np.frombuffer(feature['data_LR'].bytes_list.value[0], dtype=dtype).reshape(h, w, c)
+            LR_shape = LR_shape or [h, w, c]
+            if [h, w, c] not in LR_shapes:
+                LR_shapes.append([h, w, c])
+            _update_stats(LR_stats, data_LR)
+
+        if 'data_HR' in feature:
+            h, w = feature['h_HR'].int64_list.value[0], feature['w_HR'].int64_list.value[0]
+            data_HR = np.frombuffer(feature['data_HR'].bytes_list.value[0], dtype=dtype).reshape(h, w, c)
+            HR_shape = HR_shape or [h, w, c]
+            _update_stats(HR_stats, data_HR)
+
+        N += 1
+
+    manifest = {'version': MANIFEST_VERSION,
+                'N': N,
+                'indices': indices,
+                'dtype': dtype,
+                'LR_shape': LR_shape,
+                'LR_shapes': sorted(LR_shapes),
+                'HR_shape': HR_shape,
+                'LR_mu': None, 'LR_sigma': None,
+                'HR_mu': None, 'HR_sigma': None}
+
+    if LR_shape is not None:
+        manifest['LR_mu'], manifest['LR_sigma'] = LR_stats[1].tolist(), np.sqrt(LR_stats[2]).tolist()
+    if HR_shape is not None:
+        manifest['HR_mu'], manifest['HR_sigma'] = HR_stats[1].tolist(), np.sqrt(HR_stats[2]).tolist()
+
+    return manifest
+
+def merge_manifests(manifests):
+    '''
+        Combine the manifests of several shards into the manifest of their concatenation
+        inputs:
+            manifests - list of manifests in shard order
+
+        outputs:
+            manifest - (dict) merged manifest, without a sidecar key
+    '''
+    merged = {'version': MANIFEST_VERSION,
+              'N': sum(m['N'] for m in manifests),
+              'indices': [i for m in manifests for i in m['indices']],
+              'dtype': manifests[0]['dtype'],
+              'LR_shape': manifests[0]['LR_shape'],
+              'LR_shapes': [list(shape) for shape in sorted(set(tuple(shape) for m in manifests for shape in m['LR_shapes']))],
+              'HR_shape': manifests[0]['HR_shape']}
+
+    for res in ['LR', 'HR']:
+        merged[res+'_mu'], merged[res+'_sigma'] = None, None
+        if all(m[res+'_mu'] is not None for m in manifests):
+            N, mu, sigma = 0, 0, 0
+            for m in manifests:
+                N_batch = m['N']
+                N_new = N + N_batch
+                mu_batch, sigma_batch = np.array(m[res+'_mu']), np.array(m[res+'_sigma'])**2
+
+                sigma = (N/N_new)*sigma + (N_batch/N_new)*sigma_batch + (N*N_batch/N_new**2)*(mu - mu_batch)**2
+                mu = (N/N_new)*mu + (N_batch/N_new)*mu_batch
+                N = N_new
+            merged[res+'_mu'], merged[res+'_sigma'] = mu.tolist(), np.sqrt(sigma).tolist()
+
+    return merged
+
+def _update_stats(stats, data):
+    '''
+        Merge the per-channel mean and variance of one sample into running [N, mu, sigma^2] stats
+    '''
+    N, mu, sigma = stats
+    N_batch = 1
+    N_new = N + N_batch
+
+    mu_batch = np.mean(data, axis=(0, 1), dtype=np.float64)
+    sigma_batch = np.var(data, axis=(0, 1), dtype=np.float64)
+
+    stats[2] = (N/N_new)*sigma + (N_batch/N_new)*sigma_batch + (N*N_batch/N_new**2)*(mu - mu_batch)**2
+    stats[1] = (N/N_new)*mu + (N_batch/N_new)*mu_batch
+    stats[0] = N_new
@@ -0,0 +1,83 @@
+''' Structured metrics and step traces for the training and inference loops.
+
+    Records are written one JSON object per line. Every record has a 'kind' ('step', 'epoch', 'test',
+    or 'bucket' for the throughput of one LR shape in a mixed-shape test run), the 'phase' it came
+    from ('pretrain', 'train' or 'test') and a wall-clock 'time'. Step and epoch records split their
+    time into 'data_time' (waiting on the input pipeline) and 'compute_time' (running the network),
+    which shows whether a run is input-bound or compute-bound.
+
+    If trace_every is set, every trace_every-th step is run with a full trace and its timeline is
+    written in Chrome trace format (open in chrome://tracing) to <trace_dir>/<phase>_step<N>.json.
+'''
+import os
+import json
+import tensorflow as tf
+from time import time
+
+class MetricsLogger(object):
+    '''
+        JSONL metrics writer. With path None all methods are no-ops, so the loops can call it unconditionally.
+    '''
+    def __init__(self, path=None, trace_every=None, trace_dir=None):
+        '''
+            inputs:
+                path        - (string) JSONL file to append records to, None to disable logging
+                trace_every - (int) capture a full step trace every trace_every steps, None to disable tracing
+                trace_dir   - (string) directory for Chrome traces, defaults to <path without extension>_traces
+        '''
+        self.path, self.trace_every = path, trace_every
+        self.file = None
+
+        if path is not None:
+            out_dir = os.path.dirname(path)
+            if out_dir and not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            self.file = open(path, 'a')
+
+        if trace_dir is None and path is not None:
+            trace_dir = os.path.splitext(path)[0] + '_traces'
+        self.trace_dir = trace_dir
+
+    def log(self, kind, phase, **fields):
+        '''
+            Write one record. NumPy scalars and arrays are converted to plain JSON numbers and lists.
+        '''
+        if self.file is None:
+            return
+
+        record = {'kind': kind, 'phase': phase, 'time': time()}
+        record.update(fields)
+        self.file.write(json.dumps(record, default=lambda value: value.tolist()) + '\n')
+
+    def trace_options(self, step):
+        '''
+            Session.run keyword arguments for a step: a full trace every trace_every steps, none otherwise
+        '''
+        if self.trace_dir is None or not self.trace_every or step % self.trace_every != 0:
+            return {}
+
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+
+    def write_trace(self, phase, step, trace):
+        '''
+            Write the timeline of a traced step, trace being the keyword arguments from trace_options
+        '''
+        if not trace:
+            return
+
+        from tensorflow.python.client import timeline
+
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        tl = timeline.Timeline(trace['run_metadata'].step_stats)
+        with open('/'.join([self.trace_dir, '{}_step{:07d}.json'.format(phase, step)]), 'w') as f:
+            f.write(tl.generate_chrome_trace_format())
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,214 @@
+''' TensorFlow-free inference for trained PhIREGANs generators.
+
+    Generator weights are read directly from the checkpoints written by g_saver (TensorFlow tensor
+    bundle format: an SSTable '.index' file and '.data-XXXXX-of-XXXXX' shards), and the forward pass of
+    SR_NETWORK.generator is reproduced with NumPy. Each stride-1 transposed convolution is computed as
+    the equivalent convolution, accumulated as k*k GEMMs over shifted views of the reflect-padded input,
+    so no im2col buffer k*k times the size of the activations is ever built.
+'''
+import struct
+import numpy as np
+
+_TABLE_MAGIC = 0xdb4775248b80fb57
+_DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 9: np.int64, 19: np.float16}
+
+def _read_varint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _parse_proto(buf):
+    '''
+        Decode a serialized protocol buffer into a dict of field number -> list of raw values
+    '''
+    fields, pos = {}, 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos+8], pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos+length], pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos+4], pos + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type %d' %(wire_type))
+        fields.setdefault(field, []).append(value)
+
+    return fields
+
+def _read_block(data, offset, size):
+    '''
+        Decode the (key, value) entries of one SSTable block
+    '''
+    assert data[offset+size] == 0, 'Compressed checkpoint index blocks are not supported'
+    block = data[offset:offset+size]
+    n_restarts = struct.unpack('<I', block[-4:])[0]
+    end = len(block) - 4*(n_restarts + 1)
+
+    entries, key, pos = [], b'', 0
+    while pos < end:
+        shared, pos = _read_varint(block, pos)
+        non_shared, pos = _read_varint(block, pos)
+        value_length, pos = _read_varint(block, pos)
+        key = key[:shared] + block[pos:pos+non_shared]
+        pos += non_shared
+        entries.append((key, block[pos:pos+value_length]))
+        pos += value_length
+
+    return entries
+
+def load_checkpoint(model_path, prefix='generator/'):
+    '''
+        Read variables from a TensorFlow checkpoint without TensorFlow
+        inputs:
+            model_path - (string) checkpoint path as passed to Saver.restore, e.g. models/.../gan/gan
+            prefix     - (string) only variables whose names start with prefix are loaded
+
+        outputs:
+            variables - (dict) variable name -> NumPy array
+    '''
+    with open(model_path + '.index', 'rb') as f:
+        index = f.read()
+
+    footer = index[-48:]
+    assert struct.unpack('<Q', footer[-8:])[0] == _TABLE_MAGIC, 'Not a TensorFlow checkpoint index: %s' %(model_path)
+    pos = 0
+    for _ in range(2): # skip the metaindex handle
+        _, pos = _read_varint(footer, pos)
+    index_offset, pos = _read_varint(footer, pos)
+    index_size, pos = _read_varint(footer, pos)
+
+    entries = []
+    for _, handle in _read_block(index, index_offset, index_size):
+        offset, pos = _read_varint(handle, 0)
+        size, _ = _read_varint(handle, pos)
+        entries.extend(_read_block(index, offset, size))
+
+    header = dict(entries).get(b'', b'')
+    num_shards = _parse_proto(header).get(1, [1])[0]
+
+    shards, variables = {}, {}
+    for key, value in entries:
+        name = key.decode()
+        if not name or not name.startswith(prefix):
+            continue
+
+        entry = _parse_proto(value)
+        dtype = _DTYPES[entry.get(1, [0])[0]]
+        shape = [_parse_proto(dim).get(1, [0])[0] for dim in _parse_proto(entry.get(2, [b''])[0]).get(2, [])]
+        shard_id, offset, size = entry.get(3, [0])[0], entry.get(4, [0])[0], entry.get(5, [0])[0]
+
+        if shard_id not in shards:
+            shards[shard_id] = np.memmap('{}.data-{:05d}-of-{:05d}'.format(model_path, shard_id, num_shards), dtype=np.uint8, mode='r')
+        variables[name] = np.frombuffer(shards[shard_id][offset:offset+size].tobytes(), dtype=dtype).reshape(shape)
+
+    return variables
+
+def deconv_layer_2d(x, W, b):
+    '''
+        NumPy equivalent of utils.deconv_layer_2d for stride 1
+        inputs:
+            x - (N, h, w, C_in) input
+            W - (k, k, C_out, C_in) conv2d_transpose filter
+            b - (C_out,) bias
+
+        outputs:
+            y - (N, h, w, C_out) output
+    '''
+    k = W.shape[0]
+    p = k//2
+    K = W[::-1, ::-1].transpose(0, 1, 3, 2)
+
+    N, h, w, C_in = x.shape
+    x = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)), mode='reflect')
+
+    y = np.empty((N*h*w, K.shape[-1]), dtype=x.dtype)
+    y[:] = b
+    for i in range(k):
+        for j in range(k):
+            y += np.ascontiguousarray(x[:, i:i+h, j:j+w, :]).reshape(-1, C_in) @ K[i, j]
+
+    return y.reshape(N, h, w, -1)
+
+def depth_to_space(x, r):
+    '''
+        NumPy equivalent of tf.depth_to_space for NHWC data
+    '''
+    N, h, w, C = x.shape
+    x = x.reshape(N, h, w, r, r, C//(r*r))
+    return x.transpose(0, 1, 3, 2, 4, 5).reshape(N, h*r, w*r, C//(r*r))
+
+def generator(x, r, variables):
+    '''
+        NumPy forward pass of SR_NETWORK.generator
+        inputs:
+            x         - (N, h, w, C) normalized LR data
+            r         - (int array) should be array of prime factorization of amount of super-resolution to perform
+            variables - (dict) generator variables from load_checkpoint
+
+        outputs:
+            x_SR - (N, R*h, R*w, C) normalized SR data
+    '''
+    def layer(x, name):
+        return deconv_layer_2d(x, variables['generator/%s/weight' %(name)], variables['generator/%s/bias' %(name)])
+
+    x = np.maximum(layer(x, 'deconv1'), 0)
+    skip_connection = x
+
+    for i in range(16):
+        B_skip_connection = x
+        x = np.maximum(layer(x, 'block_{}a'.format(i+1)), 0)
+        x = layer(x, 'block_{}b'.format(i+1))
+        x += B_skip_connection
+
+    x = layer(x, 'deconv2')
+    x += skip_connection
+
+    for i, r_i in enumerate(r):
+        x = layer(x, 'deconv{}'.format(i+3))
+        x = np.maximum(depth_to_space(x, r_i), 0)
+
+    return layer(x, 'deconv_out')
+
+class NumpySRGenerator(object):
+    '''
+        A trained generator evaluated with NumPy, mapping LR data in physical units to SR data in
+        physical units. Drop-in replacement for sr_server.SRGenerator on machines without TensorFlow.
+    '''
+    def __init__(self, r, model_path, mu_sig, batch_size=8):
+        '''
+            inputs:
+                r          - (int array) should be array of prime factorization of amount of super-resolution to perform
+                model_path - (string) path of the generator checkpoint
+                mu_sig     - mean, standard deviation of the training data
+                batch_size - (int) number of samples evaluated at once
+        '''
+        self.r, self.model_path, self.batch_size = r, model_path, batch_size
+        self.variables = {name: v.astype(np.float32) for name, v in load_checkpoint(model_path).items()}
+        self.mu = np.array(mu_sig[0], dtype=np.float32)
+        self.sigma = np.array(mu_sig[1], dtype=np.float32)
+
+    def __call__(self, LR):
+        '''
+            inputs:
+                LR - (N, h, w, C) array of LR data in physical units
+
+            outputs:
+                SR - (N, R*h, R*w, C) array of SR data in physical units
+        '''
+        LR = (np.asarray(LR, dtype=np.float32) - self.mu)/self.sigma
+        SR = [generator(LR[i:i+self.batch_size], self.r, self.variables) for i in range(0, LR.shape[0], self.batch_size)]
+
+        return self.sigma*np.concatenate(SR, axis=0) + self.mu
+
+    def close(self):
+        pass
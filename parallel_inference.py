@@ -0,0 +1,160 @@
+''' Multi-process data-parallel inference across TFRecord shards and CPU cores.
+
+    The input records are split across worker processes (by file when there are at least as many shards
+    as workers, by record otherwise). Each worker is pinned to its own set of cores, gets a matching
+    intra/inter-op thread budget, restores the generator into its own session, and writes its results
+    into a shared, preallocated .npy file at the row of each record's index. The output is therefore in
+    the same order as a single-process test() run, regardless of which worker finishes first.
+
+    example:
+        python parallel_inference.py --r 2 5 --data_path 'example_data/wind_LR-MR-*.tfrecord' \
+                                     --model_path models/wind_lr-mr/trained_gan/gan \
+                                     --mu_sig '[[0.7684, -0.4575], [4.9491, 5.8441]]' \
+                                     --workers 1 2 4 8 --data_out_path data_out/parallel
+'''
+import os
+import json
+import argparse
+import numpy as np
+import multiprocessing as mp
+from time import time
+from manifest import load_manifest
+from utils import expand_data_paths
+
+def _worker(args):
+    '''
+        Run the generator on one worker's share of the records and write the results
+    '''
+    worker_id, n_workers, r, data_path, model_path, mu_sig, batch_size, cores, out_path, row_of = args
+
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    import tensorflow as tf
+    from PhIREGANs import PhIREGANs
+    from sr_server import SRGenerator
+
+    n_threads = max(len(cores), 1)
+    config = tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=2)
+
+    t_start = time()
+    generator = SRGenerator(r, model_path, mu_sig, config=config)
+
+    files = expand_data_paths(data_path)
+    phiregans = PhIREGANs(data_type='parallel', mu_sig=mu_sig)
+    with tf.Graph().as_default():
+        if len(files) >= n_workers:
+            ds = phiregans._record_dataset(files[worker_id::n_workers], training=False)
+        else:
+            ds = phiregans._record_dataset(files, training=False).shard(n_workers, worker_id)
+        ds = ds.map(lambda xx: phiregans._parse_test_(xx, None), num_parallel_calls=n_threads)
+        ds = ds.batch(batch_size).prefetch(2)
+        idx, LR_out = ds.make_one_shot_iterator().get_next()
+
+        data_out = np.load(out_path, mmap_mode='r+')
+        N = 0
+        with tf.Session(config=config) as sess:
+            try:
+                while True:
+                    batch_idx, batch_LR = sess.run([idx, LR_out])
+                    data_out[[row_of[i] for i in batch_idx]] = generator(batch_LR)
+                    N += len(batch_idx)
+            except tf.errors.OutOfRangeError:
+                pass
+        data_out.flush()
+
+    generator.close()
+
+    return worker_id, N, time() - t_start
+
+def parallel_test(r, data_path, model_path, mu_sig, n_workers, data_out_path, batch_size=16, cores_per_worker=None):
+    '''
+        Super-resolve test data with n_workers processes
+        inputs:
+            r                - (int array) should be array of prime factorization of amount of super-resolution to perform
+            data_path        - (string or list of strings) path, glob pattern, or list of paths of test data shards
+            model_path       - (string) path of generator checkpoint or frozen generator (.pb)
+            mu_sig           - mean, standard deviation of the training data
+            n_workers        - (int) number of worker processes
+            data_out_path    - (string) directory to write dataSR.npy to
+            batch_size       - (int) number of samples each worker runs at once
+            cores_per_worker - (int) cores pinned to each worker, defaults to an even split of the machine
+
+        outputs:
+            report - (dict) worker count, sample count, wall time and samples/sec
+    '''
+    manifest = load_manifest(data_path)
+    indices = manifest['indices']
+    row_of = {i: row for row, i in enumerate(indices)}
+    assert len(row_of) == len(indices), 'Record indices must be unique across the data to order the output'
+
+    h, w, C = manifest['LR_shape']
+    R = int(np.prod(r))
+
+    if not os.path.exists(data_out_path):
+        os.makedirs(data_out_path)
+    out_path = data_out_path + '/dataSR.npy'
+    np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(indices), h*R, w*R, C)).flush()
+
+    n_cpus = os.cpu_count()
+    if cores_per_worker is None:
+        cores_per_worker = max(n_cpus//n_workers, 1)
+    jobs = [(i, n_workers, r, data_path, model_path, mu_sig, batch_size,
+             [c % n_cpus for c in range(i*cores_per_worker, (i+1)*cores_per_worker)], out_path, row_of)
+            for i in range(n_workers)]
+
+    print('Running test data on %d workers ...' %(n_workers), end=' ', flush=True)
+    t_start = time()
+    with mp.get_context('spawn').Pool(n_workers) as pool:
+        results = pool.map(_worker, jobs, chunksize=1)
+    elapsed = time() - t_start
+    print('Done.')
+
+    N = sum(n for _, n, _ in results)
+    return {'workers': n_workers,
+            'cores_per_worker': cores_per_worker,
+            'samples': N,
+            'seconds': elapsed,
+            'samples_per_sec': N/elapsed,
+            'worker_seconds': [t for _, _, t in sorted(results)]}
+
+def scaling_report(r, data_path, model_path, mu_sig, worker_counts, data_out_path, batch_size=16, report_path=None):
+    '''
+        Run parallel_test for several worker counts and report samples/sec against worker count
+        inputs:
+            worker_counts - (int array) worker counts to try
+            report_path   - (string) JSON file to write the report to, defaults to <data_out_path>/scaling.json
+            other inputs as in parallel_test
+
+        outputs:
+            reports - list of parallel_test reports
+    '''
+    reports = []
+    for n_workers in worker_counts:
+        report = parallel_test(r, data_path, model_path, mu_sig, n_workers, data_out_path, batch_size)
+        report['speedup'] = report['samples_per_sec']/reports[0]['samples_per_sec'] if reports else 1.0
+        reports.append(report)
+        print('workers=%d, samples/sec=%.2f, speedup=%.2f' %(n_workers, report['samples_per_sec'], report['speedup']), flush=True)
+
+    if report_path is None:
+        report_path = data_out_path + '/scaling.json'
+    with open(report_path, 'w') as f:
+        json.dump(reports, f, indent=2)
+
+    return reports
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-process PhIREGANs inference')
+    parser.add_argument('--r', type=int, nargs='+', required=True, help='prime factorization of the super-resolution')
+    parser.add_argument('--data_path', nargs='+', required=True, help='test data paths or glob patterns')
+    parser.add_argument('--model_path', required=True, help='generator checkpoint or frozen generator (.pb)')
+    parser.add_argument('--mu_sig', type=json.loads, default=None, help='JSON [[mu...], [sigma...]], not needed for .pb models')
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count()], help='worker count(s); several give a scaling report')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--data_out_path', required=True)
+    args = parser.parse_args()
+
+    if len(args.workers) == 1:
+        print(parallel_test(args.r, args.data_path, args.model_path, args.mu_sig, args.workers[0], args.data_out_path, args.batch_size))
+    else:
+        scaling_report(args.r, args.data_path, args.model_path, args.mu_sig, args.workers, args.data_out_path, args.batch_size)
@@ -0,0 +1,279 @@
+''' Post-training quantization of frozen generators for CPU inference.
+
+    Starting from a frozen generator written by PhIREGANs.export_generator (which takes and returns
+    physical units, with mu_sig folded into the first and last layers), this writes a smaller .pb that
+    can be used anywhere a frozen generator is accepted (test(), sr_server.SRGenerator, parallel_inference):
+
+        int8         - weights and convolutions are quantized to eight bits with quantize_weights and
+                       quantize_nodes. Activation ranges are calibrated on a sample of the training data
+                       and frozen into the graph with freeze_requantization_ranges, so no ranges are
+                       computed at run time.
+        int8_weights - weights are stored as eight bits and dequantized on load, computation stays float32.
+        bfloat16     - weights are stored as bfloat16 and cast to float32 on load, computation stays float32.
+
+    Since normalization is folded into the frozen graph, calibrating on data in physical units gives
+    the same activation ranges as running the original generator on mu_sig-normalized data.
+
+    The error of the quantized generator against the float32 one is reported per channel in physical
+    units (e.g. m/s for ua/va, W/m^2 for DNI/DHI), together with throughput and file size.
+
+    example:
+        python quantize.py --model_path models/wind_lr-mr/generator.pb --data_path example_data/wind_LR-MR.tfrecord \
+                           --mode int8 --data_type wind
+'''
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from time import time
+from tensorflow.core.framework import tensor_pb2
+from PhIREGANs import PhIREGANs
+from sr_store import CHANNEL_NAMES
+
+def load_graph_def(model_path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(model_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+def save_graph_def(graph_def, model_path):
+    out_dir = os.path.dirname(model_path)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with tf.gfile.GFile(model_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+def sample_LR(data_path, N, seed=0):
+    '''
+        Draw up to N LR samples in physical units from training or test data through the PhIREGANs input pipeline
+        inputs:
+            data_path - (string or list of strings) path, glob pattern, or list of paths of the tfrecords
+            N         - (int) number of samples
+            seed      - (int) seed for the shuffle
+
+        outputs:
+            LR - (N, h, w, C) array of LR data in physical units
+    '''
+    phiregans = PhIREGANs(data_type='quantize')
+    with tf.Graph().as_default():
+        ds = phiregans._record_dataset(data_path, training=False)
+        ds = ds.shuffle(phiregans.shuffle_buffer, seed=seed)
+        ds = ds.map(lambda xx: phiregans._parse_test_(xx, None)).batch(N)
+        _, LR_out = ds.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            return sess.run(LR_out)
+
+def calibrate_ranges(graph_def, LR, batch_size=8):
+    '''
+        Run a quantize_nodes graph on calibration data and record the range of every requantized tensor
+        inputs:
+            graph_def  - GraphDef containing RequantizationRange nodes
+            LR         - (N, h, w, C) calibration data in physical units
+            batch_size - (int) number of samples run at once
+
+        outputs:
+            ranges - (dict) RequantizationRange node name -> (min, max) over all calibration data
+    '''
+    names = [node.name for node in graph_def.node if node.op == 'RequantizationRange']
+
+    ranges = {}
+    with tf.Graph().as_default():
+        x_LR = tf.placeholder(tf.float32, [None, None, None, LR.shape[-1]])
+        fetches = tf.import_graph_def(graph_def, input_map={'x_LR:0': x_LR},
+                                      return_elements=[n+':0' for n in names] + [n+':1' for n in names], name='')
+        with tf.Session() as sess:
+            for i in range(0, LR.shape[0], batch_size):
+                values = sess.run(fetches, feed_dict={x_LR: LR[i:i+batch_size]})
+                for name, lo, hi in zip(names, values[:len(names)], values[len(names):]):
+                    lo0, hi0 = ranges.get(name, (lo, hi))
+                    ranges[name] = (min(lo0, lo), max(hi0, hi))
+
+    return ranges
+
+def quantize_int8(graph_def, LR, batch_size=8, log_path=None):
+    '''
+        Quantize a frozen generator to eight bits with calibrated activation ranges
+        inputs:
+            graph_def  - float32 frozen generator GraphDef
+            LR         - (N, h, w, C) calibration data in physical units
+            batch_size - (int) number of calibration samples run at once
+            log_path   - (string) where to keep the min/max log read by freeze_requantization_ranges,
+                         a temporary file if None
+
+        outputs:
+            graph_def - quantized GraphDef
+    '''
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    print('Quantizing network ...', end=' ')
+    q_def = TransformGraph(graph_def, ['x_LR'], ['x_SR'], ['quantize_weights', 'quantize_nodes'])
+    print('Done.')
+
+    print('Calibrating on %d samples ...' %(LR.shape[0]), end=' ')
+    ranges = calibrate_ranges(q_def, LR, batch_size)
+
+    keep_log = log_path is not None
+    if not keep_log:
+        fd, log_path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+
+    # Same line format as the insert_logging(op=RequantizationRange) output the transform expects
+    with open(log_path, 'w') as f:
+        for name, (lo, hi) in sorted(ranges.items()):
+            f.write(';%s__print__;__requant_min_max:[%.9g][%.9g]\n' %(name, lo, hi))
+
+    q_def = TransformGraph(q_def, ['x_LR'], ['x_SR'], ['freeze_requantization_ranges(min_max_log_file="%s")' %(log_path),
+                                                       'fold_constants(ignore_errors=true)', 'strip_unused_nodes'])
+    if not keep_log:
+        os.remove(log_path)
+    print('Done.')
+
+    return q_def
+
+def quantize_int8_weights(graph_def):
+    '''
+        Store the weights of a frozen generator as eight bits, dequantized to float32 when the graph is loaded
+    '''
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    return TransformGraph(graph_def, ['x_LR'], ['x_SR'], ['quantize_weights'])
+
+def quantize_bfloat16(graph_def, min_size=1024):
+    '''
+        Store float32 constants with at least min_size elements as bfloat16 (round to nearest even),
+        each followed by a cast back to float32 under the original node name
+        inputs:
+            graph_def - float32 frozen generator GraphDef
+            min_size  - (int) smaller constants (biases, shapes) are kept as float32
+
+        outputs:
+            graph_def - GraphDef with bfloat16 weights
+    '''
+    out = tf.GraphDef()
+    for node in graph_def.node:
+        if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+            out.node.extend([node])
+            continue
+
+        value = tf.make_ndarray(node.attr['value'].tensor).astype(np.float32)
+        if value.size < min_size:
+            out.node.extend([node])
+            continue
+
+        bits = value.view(np.uint32)
+        bits = ((bits + 0x7fff + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+        const = out.node.add()
+        const.op, const.name = 'Const', node.name + '_bfloat16'
+        const.attr['dtype'].type = tf.bfloat16.as_datatype_enum
+        const.attr['value'].tensor.CopyFrom(tensor_pb2.TensorProto(dtype=tf.bfloat16.as_datatype_enum,
+                                                                   tensor_shape=tf.TensorShape(value.shape).as_proto(),
+                                                                   tensor_content=bits.tobytes()))
+
+        cast = out.node.add()
+        cast.op, cast.name = 'Cast', node.name
+        cast.input.append(const.name)
+        cast.attr['SrcT'].type = tf.bfloat16.as_datatype_enum
+        cast.attr['DstT'].type = tf.float32.as_datatype_enum
+
+    out.versions.CopyFrom(graph_def.versions)
+    return out
+
+def evaluate(reference_path, model_path, LR, channel_names=None, batch_size=8):
+    '''
+        Compare a quantized generator against the float32 one on the same LR data
+        inputs:
+            reference_path - (string) float32 frozen generator (.pb)
+            model_path     - (string) quantized frozen generator (.pb)
+            LR             - (N, h, w, C) evaluation data in physical units
+            channel_names  - (list of strings) names of the data channels, e.g. ['ua', 'va']
+
+        outputs:
+            report - (dict) per-channel RMSE, mean and max absolute error in physical units, the RMSE
+                     relative to the channel standard deviation, throughput and file size of both models
+    '''
+    from sr_server import SRGenerator
+
+    C = LR.shape[-1]
+    channel_names = channel_names or ['channel_%d' %(c) for c in range(C)]
+
+    SR, seconds = {}, {}
+    for key, path in [('float32', reference_path), ('quantized', model_path)]:
+        generator = SRGenerator(None, path)
+        generator(LR[:batch_size]) # warm up
+        t_start = time()
+        SR[key] = np.concatenate([generator(LR[i:i+batch_size]) for i in range(0, LR.shape[0], batch_size)], axis=0)
+        seconds[key] = time() - t_start
+        generator.close()
+
+    err = SR['quantized'] - SR['float32']
+    report = {'samples': LR.shape[0], 'channels': {}}
+    for c, name in enumerate(channel_names):
+        rmse = float(np.sqrt(np.mean(err[..., c]**2)))
+        report['channels'][name] = {'rmse': rmse,
+                                    'mean_abs_error': float(np.mean(np.abs(err[..., c]))),
+                                    'max_abs_error': float(np.max(np.abs(err[..., c]))),
+                                    'relative_rmse': rmse/float(np.std(SR['float32'][..., c]))}
+    for key, path in [('float32', reference_path), ('quantized', model_path)]:
+        report[key] = {'samples_per_sec': LR.shape[0]/seconds[key], 'bytes': os.path.getsize(path)}
+    report['speedup'] = seconds['float32']/seconds['quantized']
+
+    return report
+
+def quantize_generator(model_path, data_path, mode='int8', out_path=None, n_calib=64, n_eval=64, channel_names=None, batch_size=8):
+    '''
+        Quantize a frozen generator and report its error against the float32 model
+        inputs:
+            model_path    - (string) float32 frozen generator written by PhIREGANs.export_generator
+            data_path     - (string or list of strings) training data used for calibration and evaluation
+            mode          - (string) 'int8', 'int8_weights' or 'bfloat16'
+            out_path      - (string) path of the .pb to write, defaults to <model_path without .pb>_<mode>.pb
+            n_calib       - (int) number of samples used to calibrate activation ranges (int8 only)
+            n_eval        - (int) number of samples used to measure the error
+            channel_names - (list of strings) names of the data channels, e.g. ['ua', 'va']
+            batch_size    - (int) number of samples run at once
+
+        outputs:
+            out_path - (string) path of the quantized generator
+            report   - (dict) see evaluate
+    '''
+    assert model_path.endswith('.pb'), 'Quantization works on frozen generators, see PhIREGANs.export_generator'
+    assert mode in ['int8', 'int8_weights', 'bfloat16'], 'mode must be int8, int8_weights or bfloat16'
+    if out_path is None:
+        out_path = model_path[:-3] + '_' + mode + '.pb'
+
+    graph_def = load_graph_def(model_path)
+    if mode == 'int8':
+        graph_def = quantize_int8(graph_def, sample_LR(data_path, n_calib), batch_size)
+    elif mode == 'int8_weights':
+        graph_def = quantize_int8_weights(graph_def)
+    else:
+        graph_def = quantize_bfloat16(graph_def)
+    save_graph_def(graph_def, out_path)
+
+    print('Evaluating against float32 network ...', end=' ')
+    report = evaluate(model_path, out_path, sample_LR(data_path, n_eval, seed=1), channel_names, batch_size)
+    report['mode'] = mode
+    print('Done.')
+
+    return out_path, report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a frozen PhIREGANs generator')
+    parser.add_argument('--model_path', required=True, help='float32 frozen generator (.pb)')
+    parser.add_argument('--data_path', nargs='+', required=True, help='training data paths or glob patterns for calibration')
+    parser.add_argument('--mode', default='int8', choices=['int8', 'int8_weights', 'bfloat16'])
+    parser.add_argument('--out_path', default=None)
+    parser.add_argument('--n_calib', type=int, default=64, help='calibration samples')
+    parser.add_argument('--n_eval', type=int, default=64, help='evaluation samples')
+    parser.add_argument('--data_type', default=None, choices=sorted(CHANNEL_NAMES), help='names the channels in the report')
+    parser.add_argument('--channels', nargs='+', default=None, help='channel names, e.g. ua va or DNI DHI')
+    parser.add_argument('--batch_size', type=int, default=8)
+    args = parser.parse_args()
+
+    out_path, report = quantize_generator(args.model_path, args.data_path, args.mode, args.out_path,
+                                          args.n_calib, args.n_eval, args.channels or CHANNEL_NAMES.get(args.data_type), args.batch_size)
+    print('Wrote %s' %(out_path))
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,129 @@
+''' Offset index of TFRecord files and globally shuffled reading.
+
+    A TFRecord file is a sequence of records, each stored as
+
+        uint64 length | uint32 masked crc of length | data[length] | uint32 masked crc of data
+
+    The index holds the byte offset and length of every record's data. It is built once by reading only
+    the record headers, and saved next to the data as <path>.idx (a .npy array of (offset, length) rows).
+    It is rebuilt when the data file is newer than the index.
+
+    With the index, records can be read in a globally shuffled order, a new one every epoch, over all
+    records of all files. Only read_ahead records are held in memory at a time, so the quality of the
+    shuffle no longer depends on the size of a shuffle buffer. Only uncompressed files can be indexed,
+    as records in GZIP/ZLIB files cannot be reached by offset. The CRCs are not checked.
+'''
+import os
+import struct
+import numpy as np
+import tensorflow as tf
+from utils import expand_data_paths, tfrecord_compression
+
+DEFAULT_READ_AHEAD = 64 # Number of records read from disk, in file order, per block of the shuffled order
+
+def index_path(data_path):
+    return data_path + '.idx'
+
+def build_index(data_path):
+    '''
+        Scan the record headers of a TFRecord file
+        inputs:
+            data_path - (string) path to an uncompressed tfrecord
+
+        outputs:
+            index - (N, 2) int64 array of the byte offset and length of each record's data
+    '''
+    assert not tfrecord_compression(data_path), 'Cannot index compressed TFRecords: %s' %(data_path)
+
+    index = []
+    size = os.path.getsize(data_path)
+    with open(data_path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            header = f.read(12)
+            assert len(header) == 12, 'Truncated record at byte %d of %s' %(offset, data_path)
+            length, = struct.unpack('<Q', header[:8])
+            index.append((offset + 12, length))
+            offset += 12 + length + 4
+            f.seek(offset)
+
+    return np.array(index, dtype=np.int64).reshape(-1, 2)
+
+def load_index(data_path):
+    '''
+        Load the offset index of a TFRecord file, building it if no up-to-date sidecar exists
+
+        outputs:
+            index - (N, 2) int64 array of the byte offset and length of each record's data
+    '''
+    sidecar = index_path(data_path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(data_path):
+        return np.load(sidecar)
+
+    print('Building record index for %s ...' %(data_path), end=' ')
+    index = build_index(data_path)
+    try:
+        tmp_path = sidecar + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        print('Could not write index (%s) ...' %(e), end=' ')
+    print('Done.')
+
+    return index
+
+def shuffled_records(files, indices, shard=None, read_ahead=DEFAULT_READ_AHEAD, seed=None):
+    '''
+        Serialized records of all files in a random order. The order is split into blocks of read_ahead
+        records; each block is read in file order and then returned in the shuffled order.
+
+        inputs:
+            files      - (list of strings) paths of the tfrecords
+            indices    - list of offset indexes, one per file
+            shard      - (num_shards, index) to only read every num_shards-th record, starting at index
+            read_ahead - (int) number of records read at a time
+            seed       - (int) seed of the order, None for a different order on every call
+
+        outputs:
+            generator of serialized records
+    '''
+    records = np.concatenate([np.column_stack([np.full(len(index), i, dtype=np.int64), index])
+                              for i, index in enumerate(indices)])
+    if shard is not None:
+        records = records[shard[1]::shard[0]]
+    records = records[np.random.RandomState(seed).permutation(len(records))]
+
+    handles = [open(f, 'rb') for f in files]
+    try:
+        for start in range(0, len(records), read_ahead):
+            block = records[start:start+read_ahead]
+            data = {}
+            for i in np.lexsort((block[:, 1], block[:, 0])):
+                f = handles[block[i, 0]]
+                f.seek(block[i, 1])
+                data[i] = f.read(block[i, 2])
+            for i in range(len(block)):
+                yield data[i]
+    finally:
+        for f in handles:
+            f.close()
+
+def shuffled_record_dataset(data_path, shard=None, read_ahead=DEFAULT_READ_AHEAD):
+    '''
+        Dataset of serialized records in a globally shuffled order, drawn anew each time its iterator is
+        initialized, i.e. every epoch. A drop-in replacement for a TFRecordDataset followed by shuffle().
+
+        inputs:
+            data_path  - (string or list of strings) path, glob pattern, or list of paths of uncompressed tfrecords
+            shard      - (num_shards, index) to read only one disjoint part of the records
+            read_ahead - (int) number of records read from disk at a time
+
+        outputs:
+            ds - tf.data.Dataset of serialized examples
+    '''
+    files = expand_data_paths(data_path)
+    indices = [load_index(f) for f in files]
+
+    return tf.data.Dataset.from_generator(lambda: shuffled_records(files, indices, shard, read_ahead),
+                                          tf.string, tf.TensorShape([]))
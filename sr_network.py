@@ -1,10 +1,11 @@
 ''' @author: Andrew Glaws, Karen Stengel, Ryan King
 '''
+import os
 import tensorflow as tf
 from utils import *
 
 class SR_NETWORK(object):
-    def __init__(self, x_LR=None, x_HR=None, r=None, status='pretraining', alpha_advers=0.001):
+    def __init__(self, x_LR=None, x_HR=None, r=None, status='pretraining', alpha_advers=0.001, deconv_as_conv=False):
 
         status = status.lower()
         if status not in ['pretraining', 'training', 'testing']:
@@ -20,7 +21,7 @@ class SR_NETWORK(object):
         if status in ['pretraining', 'training']:
             self.x_SR = self.generator(self.x_LR, r=r, is_training=True)
         else:
-            self.x_SR = self.generator(self.x_LR, r=r, is_training=False)
+            self.x_SR = self.generator(self.x_LR, r=r, is_training=False, as_conv=deconv_as_conv)
 
         self.g_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='generator')
 
@@ -31,8 +32,10 @@ class SR_NETWORK(object):
             self.advers_perf, self.content_loss, self.g_advers_loss = None, None, None
 
         elif status == 'training':
-            self.disc_HR = self.discriminator(self.x_HR, reuse=False)
-            self.disc_SR = self.discriminator(self.x_SR, reuse=True)
+            # Evaluate the discriminator once on the stacked HR and SR batches
+            N_HR = tf.shape(self.x_HR)[0]
+            disc_out = self.discriminator(tf.concat([self.x_HR, self.x_SR], axis=0), reuse=False)
+            self.disc_HR, self.disc_SR = disc_out[:N_HR], disc_out[N_HR:]
             self.d_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='discriminator')
 
             loss_out = self.compute_losses(self.x_HR, self.x_SR, self.disc_HR, self.disc_SR, alpha_advers, isGAN=True)
@@ -49,7 +52,7 @@ class SR_NETWORK(object):
             self.disc_HR, self.disc_SR, self.d_variables = None, None, None
 
 
-    def generator(self, x, r, is_training=False, reuse=False):
+    def generator(self, x, r, is_training=False, reuse=False, as_conv=False):
         if is_training:
             N, h, w, C = tf.shape(x)[0], x.get_shape()[1], x.get_shape()[2], x.get_shape()[3]
         else:
@@ -62,7 +65,7 @@ class SR_NETWORK(object):
             with tf.variable_scope('deconv1'):
                 C_in, C_out = C, 64
                 output_shape[-1] = C_out
-                x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k)
+                x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k, as_conv)
                 x = tf.nn.relu(x)
 
             skip_connection = x
@@ -74,16 +77,16 @@ class SR_NETWORK(object):
                 B_skip_connection = x
 
                 with tf.variable_scope('block_{}a'.format(i+1)):
-                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k)
+                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k, as_conv)
                     x = tf.nn.relu(x)
 
                 with tf.variable_scope('block_{}b'.format(i+1)):
-                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k)
+                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k, as_conv)
 
                 x = tf.add(x, B_skip_connection)
 
             with tf.variable_scope('deconv2'):
-                x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k)
+                x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k, as_conv)
                 x = tf.add(x, skip_connection)
 
             # Super resolution scaling
@@ -92,7 +95,7 @@ class SR_NETWORK(object):
                 C_out = (r_i**2)*C_in
                 with tf.variable_scope('deconv{}'.format(i+3)):
                     output_shape = [N, r_prod*h+2*k, r_prod*w+2*k, C_out]
-                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k)
+                    x = deconv_layer_2d(x, [k, k, C_out, C_in], output_shape, stride, k, as_conv)
                     x = tf.depth_to_space(x, r_i)
                     x = tf.nn.relu(x)
 
@@ -100,7 +103,7 @@ class SR_NETWORK(object):
 
             output_shape = [N, r_prod*h+2*k, r_prod*w+2*k, C]
             with tf.variable_scope('deconv_out'):
-                x = deconv_layer_2d(x, [k, k, C, C_in], output_shape, stride, k)
+                x = deconv_layer_2d(x, [k, k, C, C_in], output_shape, stride, k, as_conv)
 
         return x
 
@@ -173,3 +176,49 @@ class SR_NETWORK(object):
         else:
             return tf.reduce_mean(content_loss)
     
+
+def build_testing_generator(x_LR, r, cache_dir=None):
+    '''
+        Build the generator in testing mode on x_LR. If cache_dir is given, the graph is imported from a
+        MetaGraph serialized there on the first call for the same (r, C), which is faster than building it
+        from Python. Cache files are keyed by the TensorFlow version and the network source, so they are
+        rebuilt when either changes.
+
+        inputs:
+            x_LR      - (N, h, w, C) LR input tensor with a known number of channels
+            r         - (int array) should be array of prime factorization of amount of super-resolution to perform
+            cache_dir - (string) directory of cached graphs, None always builds the network
+
+        outputs:
+            x_SR        - SR output tensor
+            g_variables - generator variables, for restoring a checkpoint
+    '''
+    if cache_dir is None:
+        model = SR_NETWORK(x_LR, r=r, status='testing')
+        return model.x_SR, model.g_variables
+
+    import hashlib
+    import utils
+
+    C = int(x_LR.get_shape()[-1])
+    source = hashlib.md5()
+    for module_path in [__file__, utils.__file__]:
+        with open(module_path, 'rb') as f:
+            source.update(f.read())
+    path = '/'.join([cache_dir, 'generator_testing_r{}_C{}_tf{}_{}.meta'.format('-'.join(map(str, r)), C, tf.__version__,
+                                                                             source.hexdigest()[:12])])
+
+    if not os.path.exists(path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, [None, None, None, C], name='x_LR')
+            tf.identity(SR_NETWORK(x, r=r, status='testing').x_SR, name='x_SR')
+            tmp_path = path + '.{}.tmp'.format(os.getpid())
+            tf.train.export_meta_graph(tmp_path, clear_devices=True)
+            os.replace(tmp_path, path)
+
+    tf.train.import_meta_graph(path, input_map={'x_LR:0': x_LR})
+    x_SR = tf.get_default_graph().get_tensor_by_name('x_SR:0')
+
+    return x_SR, tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='generator')
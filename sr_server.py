@@ -0,0 +1,288 @@
+''' Persistent super-resolution service.
+
+    The trained generator is loaded once into a warm session. LR arrays are posted as .npy bytes
+    over HTTP and concurrent requests that share a spatial shape are coalesced into batches of up to
+    max_batch_size samples, waiting at most max_latency seconds for a batch to fill.
+
+    example:
+        python sr_server.py --r 2 5 --model_path models/wind_lr-mr/trained_gan/gan \
+                            --mu_sig '[[0.7684, -0.4575], [4.9491, 5.8441]]' --port 8000
+
+    endpoints:
+        POST /sr    - body is an (N, h, w, C) or (h, w, C) LR array saved with np.save, response is the SR array
+        GET  /stats - JSON latency and throughput counters
+'''
+import io
+import json
+import argparse
+import threading
+import socketserver
+import numpy as np
+import tensorflow as tf
+from time import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.request import urlopen
+from sr_network import build_testing_generator
+from utils import import_frozen_generator
+
+class SRGenerator(object):
+    '''
+        A trained generator kept in its own graph and session, mapping LR data in physical units to
+        SR data in physical units.
+    '''
+    def __init__(self, r, model_path, mu_sig=None, config=None, graph_cache_dir=None):
+        '''
+            inputs:
+                r               - (int array) should be array of prime factorization of amount of super-resolution to perform
+                model_path      - (string) path of the generator checkpoint or frozen generator (.pb)
+                mu_sig          - mean, standard deviation of the training data. not needed for frozen generators
+                config          - (tf.ConfigProto) session configuration, e.g. thread counts
+                graph_cache_dir - (string) directory of serialized generator graphs to import instead of
+                                  building the network, see sr_network.build_testing_generator
+        '''
+        self.r, self.model_path = r, model_path
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+            if model_path.endswith('.pb'):
+                self.x_LR = tf.placeholder(tf.float32, [None, None, None, None])
+                self.x_SR = import_frozen_generator(model_path, self.x_LR)
+                self.sess = tf.Session(graph=self.graph, config=config)
+
+            else:
+                assert mu_sig is not None, 'Value for mu_sig must be given for checkpoints.'
+                mu, sigma = np.array(mu_sig[0], dtype=np.float32), np.array(mu_sig[1], dtype=np.float32)
+
+                self.x_LR = tf.placeholder(tf.float32, [None, None, None, mu.size])
+                x_SR, g_variables = build_testing_generator((self.x_LR - mu)/sigma, r, graph_cache_dir)
+                self.x_SR = sigma*x_SR + mu
+
+                g_saver = tf.train.Saver(var_list=g_variables)
+                self.sess = tf.Session(graph=self.graph, config=config)
+                g_saver.restore(self.sess, model_path)
+
+        self.graph.finalize()
+
+    def __call__(self, LR):
+        '''
+            inputs:
+                LR - (N, h, w, C) array of LR data in physical units
+
+            outputs:
+                SR - (N, R*h, R*w, C) array of SR data in physical units
+        '''
+        return self.sess.run(self.x_SR, feed_dict={self.x_LR: LR})
+
+    def close(self):
+        self.sess.close()
+
+class _Request(object):
+    def __init__(self, LR):
+        self.LR, self.SR, self.error = LR, None, None
+        self.t_submit = time()
+        self.done = threading.Event()
+
+class SRBatcher(object):
+    '''
+        Coalesces concurrent super-resolution requests into batches. Requests are grouped by the
+        shape of their samples, and a batch is run once it holds max_batch_size samples or its
+        oldest request has waited max_latency seconds.
+    '''
+    def __init__(self, generator, max_batch_size=16, max_latency=0.01):
+        self.generator = generator
+        self.max_batch_size, self.max_latency = max_batch_size, max_latency
+
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.running = True
+
+        self.t_start = time()
+        self.n_requests, self.n_samples, self.n_batches, self.compute_time = 0, 0, 0, 0.
+        self.latencies = deque(maxlen=1000)
+
+        self.thread = threading.Thread(target=self._batch_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, LR):
+        '''
+            Super-resolve one request, blocking until its batch has run
+            inputs:
+                LR - (N, h, w, C) array of LR data in physical units
+
+            outputs:
+                SR - (N, R*h, R*w, C) array of SR data in physical units
+        '''
+        request = _Request(np.asarray(LR, dtype=np.float32))
+        with self.cond:
+            self.pending.setdefault(request.LR.shape[1:], []).append(request)
+            self.cond.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.SR
+
+    def stats(self):
+        with self.cond:
+            elapsed = time() - self.t_start
+            latencies = np.array(self.latencies)
+            return {'requests': self.n_requests,
+                    'samples': self.n_samples,
+                    'batches': self.n_batches,
+                    'mean_batch_size': self.n_samples/max(self.n_batches, 1),
+                    'samples_per_sec': self.n_samples/elapsed,
+                    'compute_seconds': self.compute_time,
+                    'uptime_seconds': elapsed,
+                    'latency_mean': float(latencies.mean()) if latencies.size else None,
+                    'latency_p50': float(np.percentile(latencies, 50)) if latencies.size else None,
+                    'latency_p95': float(np.percentile(latencies, 95)) if latencies.size else None}
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def _next_batch(self):
+        '''
+            Wait for and remove the next batch of requests from the pending queues
+        '''
+        with self.cond:
+            while self.running and not self.pending:
+                self.cond.wait()
+            if not self.running:
+                return []
+
+            # Serve the shape whose oldest request has waited longest
+            shape = min(self.pending, key=lambda s: self.pending[s][0].t_submit)
+            deadline = self.pending[shape][0].t_submit + self.max_latency
+            while self.running and sum(len(q.LR) for q in self.pending[shape]) < self.max_batch_size and time() < deadline:
+                self.cond.wait(deadline - time())
+
+            queue, batch, N = self.pending[shape], [], 0
+            while queue and (not batch or N + len(queue[0].LR) <= self.max_batch_size):
+                request = queue.pop(0)
+                batch.append(request)
+                N += len(request.LR)
+            if not queue:
+                del self.pending[shape]
+
+            return batch
+
+    def _batch_loop(self):
+        while self.running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            t0 = time()
+            try:
+                SR = self.generator(np.concatenate([request.LR for request in batch], axis=0))
+                start = 0
+                for request in batch:
+                    request.SR = SR[start:start+len(request.LR)]
+                    start += len(request.LR)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            t1 = time()
+
+            with self.cond:
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                self.n_samples += sum(len(request.LR) for request in batch)
+                self.compute_time += t1 - t0
+                self.latencies.extend(t1 - request.t_submit for request in batch)
+
+            for request in batch:
+                request.done.set()
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _SRHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/sr':
+            self.send_error(404)
+            return
+
+        try:
+            LR = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))))
+            if LR.ndim == 3:
+                SR = self.server.batcher.submit(LR[None])[0]
+            else:
+                SR = self.server.batcher.submit(LR)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+
+        out = io.BytesIO()
+        np.save(out, SR)
+        self._respond(out.getvalue(), 'application/octet-stream')
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self._respond(json.dumps(self.server.batcher.stats()).encode(), 'application/json')
+
+    def _respond(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(generator, host='127.0.0.1', port=8000, max_batch_size=16, max_latency=0.01):
+    '''
+        Run the super-resolution service until interrupted
+        inputs:
+            generator      - SRGenerator to serve
+            host, port     - address to listen on
+            max_batch_size - (int) maximum number of samples run together
+            max_latency    - (float) maximum seconds a request waits for its batch to fill
+    '''
+    server = _ThreadingHTTPServer((host, port), _SRHandler)
+    server.batcher = SRBatcher(generator, max_batch_size, max_latency)
+
+    print('Serving super-resolution on http://%s:%d ...' %(host, port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        generator.close()
+    print('Done.')
+
+def request_sr(LR, host='127.0.0.1', port=8000):
+    '''
+        Client helper: send an LR array to a running service and return the SR array
+    '''
+    body = io.BytesIO()
+    np.save(body, np.asarray(LR, dtype=np.float32))
+    with urlopen('http://%s:%d/sr' %(host, port), data=body.getvalue()) as response:
+        return np.load(io.BytesIO(response.read()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a trained PhIREGANs generator over HTTP')
+    parser.add_argument('--model_path', required=True, help='generator checkpoint or frozen generator (.pb)')
+    parser.add_argument('--r', type=int, nargs='+', required=True, help='prime factorization of the super-resolution')
+    parser.add_argument('--mu_sig', type=json.loads, default=None, help='JSON [[mu...], [sigma...]], not needed for .pb models')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_latency', type=float, default=0.01, help='seconds a request may wait for its batch to fill')
+    args = parser.parse_args()
+
+    print('Loading saved network ...', end=' ')
+    generator = SRGenerator(args.r, args.model_path, args.mu_sig)
+    print('Done.')
+
+    serve(generator, args.host, args.port, args.max_batch_size, args.max_latency)
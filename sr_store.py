@@ -0,0 +1,278 @@
+''' Chunked, index-addressable store for super-resolved data.
+
+    A store is a directory holding two files:
+
+        chunks.bin - zlib-compressed chunks of float data, appended as they are written
+        index.json - where each chunk lives, plus the metadata of the run (mu_sig, r, model path,
+                     channel names, ...)
+
+    While the store is being written, the location of each sample's chunks is appended to
+    index.journal instead, so an interrupted writer can be resumed.
+
+    Each sample, keyed by its record 'index', is cut into chunk_size x chunk_size spatial tiles of
+    all channels, and every tile is compressed separately. Reading one sample therefore only
+    decompresses that sample, and reading a spatial window only decompresses the tiles it overlaps.
+    Samples may have different shapes.
+
+    example:
+        store = SRStore('data_out/wind-20200101-120000/dataSR.store')
+        ua = store.read(1234, window=(0, 100, 0, 100))[..., store.metadata['channel_names'].index('ua')]
+'''
+import os
+import json
+import zlib
+import queue
+import threading
+import numpy as np
+
+CHANNEL_NAMES = {'wind': ['ua', 'va'], 'solar': ['DNI', 'DHI']}
+DEFAULT_CHUNK_SIZE = 256 # Height/width in HR pixels of the compressed tiles of each sample
+DEFAULT_FLUSH_EVERY = 10 # Number of batches written between syncs of the chunks and journal to disk
+STORE_VERSION = 1
+
+INDEX_FILE = 'index.json'
+CHUNKS_FILE = 'chunks.bin'
+JOURNAL_FILE = 'index.journal'
+
+def _tile_bounds(h, w, chunk_size):
+    return [(y, min(y + chunk_size, h), x, min(x + chunk_size, w))
+            for y in range(0, h, chunk_size) for x in range(0, w, chunk_size)]
+
+class SRStoreWriter(object):
+    '''
+        Writes batches of SR data to a store. Batches are compressed and written from a background
+        thread through a bounded queue, like SRDataWriter, so compression overlaps with generator compute.
+        The chunks and journal are synced to disk every flush_every batches.
+    '''
+    def __init__(self, path, N=None, metadata=None, chunk_size=DEFAULT_CHUNK_SIZE, compression_level=1, max_queue=4, resume=False,
+                 flush_every=DEFAULT_FLUSH_EVERY):
+        '''
+            inputs:
+                path              - (string) directory of the store, created if needed. An existing store is overwritten
+                                    unless resume is set
+                N                 - (int) number of samples that will be written, only used to warn about missing samples
+                metadata          - (dict) JSON-serializable description of the data, e.g. mu_sig, r, model_path, channel_names
+                chunk_size        - (int) height/width in pixels of the compressed tiles
+                compression_level - (int) zlib level, 1 (fast) to 9 (small)
+                max_queue         - (int) number of batches that may wait to be written before write() blocks
+                resume            - (bool) keep the samples of a previous, possibly interrupted, writer of this store
+                flush_every       - (int) number of batches written between syncs to disk
+        '''
+        self.path, self.N, self.flush_every = path, N, flush_every
+        self.pending = []
+        self.chunk_size, self.compression_level = chunk_size, compression_level
+        self.index = {'version': STORE_VERSION, 'chunk_size': chunk_size, 'dtype': None,
+                      'metadata': metadata or {}, 'samples': {}}
+        self.error = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        chunks_path = '/'.join([path, CHUNKS_FILE])
+        if resume and os.path.exists(chunks_path):
+            self._load_previous()
+            end = max([offset + length for entry in self.index['samples'].values() for offset, length in entry['chunks']] + [0])
+            self.file = open(chunks_path, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(chunks_path, 'wb')
+
+        # Until close() the journal is the only record of the samples, also those kept from before
+        self.journal = open('/'.join([path, JOURNAL_FILE]), 'w')
+        for idx, entry in self.index['samples'].items():
+            self._journal(idx, entry)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        if os.path.exists('/'.join([path, INDEX_FILE])):
+            os.remove('/'.join([path, INDEX_FILE]))
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, batch, indices, done=None):
+        '''
+            inputs:
+                batch   - (N_batch, h, w, C) array of samples
+                indices - (int array) record index of each sample
+                done    - function called once the batch has been flushed to disk, at the latest by close()
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((batch, indices, done))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            try:
+                self._flush()
+            except Exception as e:
+                self.error = e
+        self.file.close()
+        self.journal.close()
+        if self.error is not None:
+            raise self.error
+
+        tmp_path = '/'.join([self.path, INDEX_FILE + '.tmp'])
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, '/'.join([self.path, INDEX_FILE]))
+        os.remove('/'.join([self.path, JOURNAL_FILE]))
+
+        n_written = len(self.index['samples'])
+        if self.N is not None and n_written != self.N:
+            print('Warning: expected %d samples but wrote %d to %s' %(self.N, n_written, self.path))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            try:
+                batch, indices, done = item
+                if self.index['dtype'] is None:
+                    self.index['dtype'] = batch.dtype.name
+                for sample, idx in zip(batch, indices):
+                    self._write_sample(np.asarray(sample, dtype=self.index['dtype']), int(idx))
+
+                self.pending.append(([str(int(idx)) for idx in indices], done))
+                if len(self.pending) >= self.flush_every:
+                    self._flush()
+            except Exception as e:
+                self.error = e
+
+    def _flush(self):
+        '''
+            Sync the chunks of the pending batches, then record them in the journal and call their done callbacks
+        '''
+        if not self.pending:
+            return
+
+        # Chunks must be on disk before the journal points at them
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        for indices, _ in self.pending:
+            for idx in indices:
+                self._journal(idx, self.index['samples'][idx])
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        for _, done in self.pending:
+            if done is not None:
+                done()
+        self.pending = []
+
+    def _journal(self, idx, entry):
+        self.journal.write(json.dumps({'index': idx, 'dtype': self.index['dtype'], 'shape': entry['shape'],
+                                       'chunks': entry['chunks']}) + '\n')
+
+    def _load_previous(self):
+        '''
+            Read the samples of a finished store from its index, or of an interrupted one from its journal
+        '''
+        index_path, journal_path = '/'.join([self.path, INDEX_FILE]), '/'.join([self.path, JOURNAL_FILE])
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                previous = json.load(f)
+            assert previous['chunk_size'] == self.chunk_size, 'Cannot resume %s with a different chunk_size' %(self.path)
+            self.index['dtype'], self.index['samples'] = previous['dtype'], previous['samples']
+
+        elif os.path.exists(journal_path):
+            with open(journal_path) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break # entry cut off by the interruption
+                    entry = json.loads(line)
+                    self.index['dtype'] = entry['dtype']
+                    self.index['samples'][entry['index']] = {'shape': entry['shape'], 'chunks': entry['chunks']}
+
+    def _write_sample(self, sample, idx):
+        h, w, C = sample.shape
+        chunks = []
+        for y0, y1, x0, x1 in _tile_bounds(h, w, self.chunk_size):
+            data = zlib.compress(np.ascontiguousarray(sample[y0:y1, x0:x1]).tobytes(), self.compression_level)
+            chunks.append([self.file.tell(), len(data)])
+            self.file.write(data)
+
+        self.index['samples'][str(idx)] = {'shape': [h, w, C], 'chunks': chunks}
+
+class SRStore(object):
+    '''
+        Lazy reader of a store written by SRStoreWriter
+    '''
+    def __init__(self, path):
+        '''
+            inputs:
+                path - (string) directory of the store
+        '''
+        self.path = path
+        with open('/'.join([path, INDEX_FILE])) as f:
+            self.index = json.load(f)
+        assert self.index['version'] <= STORE_VERSION, 'Store %s was written by a newer version' %(path)
+
+        self.metadata = self.index['metadata']
+        self.chunk_size = self.index['chunk_size']
+        self.dtype = np.dtype(self.index['dtype'] or 'float32')
+        self.file = open('/'.join([path, CHUNKS_FILE]), 'rb')
+
+    @property
+    def indices(self):
+        return sorted(int(idx) for idx in self.index['samples'])
+
+    def __len__(self):
+        return len(self.index['samples'])
+
+    def __contains__(self, idx):
+        return str(int(idx)) in self.index['samples']
+
+    def shape(self, idx):
+        '''
+            (h, w, C) of the sample with record index idx
+        '''
+        return tuple(self._entry(idx)['shape'])
+
+    def read(self, idx, window=None):
+        '''
+            Read one sample, or a spatial window of it, decompressing only the tiles that overlap the window
+            inputs:
+                idx    - (int) record index of the sample
+                window - (y0, y1, x0, x1) HR pixel bounds of the window, None for the whole sample
+
+            outputs:
+                data - (y1-y0, x1-x0, C) array
+        '''
+        entry = self._entry(idx)
+        h, w, C = entry['shape']
+        y0, y1, x0, x1 = window if window is not None else (0, h, 0, w)
+        y0, y1, x0, x1 = max(y0, 0), min(y1, h), max(x0, 0), min(x1, w)
+        assert y0 < y1 and x0 < x1, 'Window %s is outside the %dx%d sample %d' %(str(window), h, w, idx)
+
+        out = np.empty((y1 - y0, x1 - x0, C), dtype=self.dtype)
+        for (ty0, ty1, tx0, tx1), (offset, length) in zip(_tile_bounds(h, w, self.chunk_size), entry['chunks']):
+            if ty1 <= y0 or ty0 >= y1 or tx1 <= x0 or tx0 >= x1:
+                continue
+            self.file.seek(offset)
+            tile = np.frombuffer(zlib.decompress(self.file.read(length)), dtype=self.dtype).reshape(ty1 - ty0, tx1 - tx0, C)
+            oy0, oy1, ox0, ox1 = max(y0, ty0), min(y1, ty1), max(x0, tx0), min(x1, tx1)
+            out[oy0-y0:oy1-y0, ox0-x0:ox1-x0] = tile[oy0-ty0:oy1-ty0, ox0-tx0:ox1-tx0]
+
+        return out
+
+    def read_all(self, indices=None):
+        '''
+            Read several samples of the same shape into one array, in the order of indices (all by default)
+        '''
+        indices = self.indices if indices is None else indices
+        return np.stack([self.read(idx) for idx in indices])
+
+    def close(self):
+        self.file.close()
+
+    def _entry(self, idx):
+        assert idx in self, 'Index %d is not in store %s' %(idx, self.path)
+        return self.index['samples'][str(int(idx))]
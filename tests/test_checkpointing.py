@@ -0,0 +1,40 @@
+''' Checkpoint retention is applied separately to every set of checkpoints in a model directory.
+'''
+import os
+import sys
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from checkpointing import CheckpointManager, latest_checkpoint, _load_state
+
+def _save_epochs(model_dir, checkpoints, losses, keep_last):
+    with tf.Graph().as_default():
+        v = tf.Variable(0., name='v')
+        manager = CheckpointManager(model_dir, [(name, name, [v]) for name in checkpoints], keep_last)
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            for epoch, loss in enumerate(losses, 1):
+                manager.save(sess, epoch, loss)
+            manager.close()
+
+def _epochs(model_dir, name):
+    return sorted(e['epoch'] for e in _load_state(model_dir)['checkpoints'] if name in e['paths'])
+
+def test_prune_per_checkpoint_set(tmpdir):
+    model_dir = str(tmpdir)
+
+    # Pretraining: MSE losses, best at epoch 1
+    _save_epochs(model_dir, ['cnn'], [0.1, 0.5, 0.4, 0.3], keep_last=1)
+    assert _epochs(model_dir, 'cnn') == [1, 4]
+
+    # Training on the same model directory: much larger GAN losses, best at epoch 2
+    _save_epochs(model_dir, ['gan', 'gan-all'], [9., 7., 8.], keep_last=1)
+    assert _epochs(model_dir, 'cnn') == [1, 4]
+    assert _epochs(model_dir, 'gan') == _epochs(model_dir, 'gan-all') == [2, 3]
+
+    for name, epoch in [('cnn', 1), ('cnn', 4), ('gan', 2), ('gan', 3)]:
+        assert os.path.isdir(os.path.join(model_dir, name + '{0:05d}'.format(epoch)))
+    assert not os.path.exists(os.path.join(model_dir, 'gan00001'))
+
+    assert latest_checkpoint(model_dir, ['gan-all', 'gan'])[1] == 3
+    assert latest_checkpoint(model_dir, ['cnn'])[1] == 4
@@ -0,0 +1,59 @@
+''' The NumPy generator must read every generator variable of a checkpoint and match the TensorFlow
+    generator it was saved from. Outputs agree to about 2e-6 of their largest magnitude (float32
+    accumulation in a different order), the tests allow 1e-4.
+'''
+import os
+import sys
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sr_network import SR_NETWORK
+from np_generator import NumpySRGenerator, load_checkpoint
+
+TOLERANCE = 1e-4 # max abs difference relative to the largest output magnitude
+C = 2
+MU_SIG = [[0.7, -0.4], [4.9, 5.8]]
+
+def _save_random_generator(model_path, r, LR):
+    '''
+        Build a testing generator with random weights and biases, save it like g_saver and run it on LR
+    '''
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+        x_LR = tf.placeholder(tf.float32, [None, None, None, C])
+        model = SR_NETWORK(x_LR, r=r, status='testing')
+        g_saver = tf.train.Saver(var_list=model.g_variables)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for v in model.g_variables:
+                if v.op.name.endswith('bias'):
+                    v.load(0.1*rng.randn(*v.shape.as_list()), sess)
+            g_saver.save(sess, model_path)
+
+            mu, sigma = np.array(MU_SIG[0]), np.array(MU_SIG[1])
+            SR = sigma*sess.run(model.x_SR, feed_dict={x_LR: (LR - mu)/sigma}) + mu
+            shapes = {v.op.name: v.shape.as_list() for v in model.g_variables}
+
+    return SR, shapes
+
+@pytest.mark.parametrize('r', [[2, 5], [5]])
+def test_numpy_generator_matches_tensorflow(tmpdir, r):
+    LR = np.random.RandomState(1).randn(3, 6, 7, C).astype(np.float32)*3 + 1
+    model_path = os.path.join(str(tmpdir), 'gan', 'gan')
+    SR_tf, shapes = _save_random_generator(model_path, r, LR)
+
+    variables = load_checkpoint(model_path)
+    assert sorted(variables) == sorted(shapes)
+    for name, shape in shapes.items():
+        assert list(variables[name].shape) == shape, name
+
+    generator = NumpySRGenerator(r, model_path, MU_SIG, batch_size=2)
+    SR_np = generator(LR)
+    generator.close()
+
+    R = int(np.prod(r))
+    assert SR_np.shape == (3, 6*R, 7*R, C)
+    assert np.max(np.abs(SR_np - SR_tf)) <= TOLERANCE*np.max(np.abs(SR_tf))
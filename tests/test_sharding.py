@@ -0,0 +1,50 @@
+''' Worker shards of the training records must be disjoint, cover all records and be balanced.
+'''
+import os
+import sys
+import numpy as np
+import pytest
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PhIREGANs import PhIREGANs
+from utils import generate_TFRecords
+
+def _write_files(path, counts):
+    files, idx_start = [], 0
+    for i, N in enumerate(counts):
+        files.append(os.path.join(str(path), 'shard-%d.tfrecord' %(i)))
+        generate_TFRecords(files[-1], np.zeros((N, 2, 2, 1)), idx_start=idx_start)
+        idx_start += N
+    return files
+
+def _read_indices(files, shard, training):
+    phiregans = PhIREGANs(data_type='test')
+    with tf.Graph().as_default():
+        ds = phiregans._record_dataset(files, training=training, shard=shard)
+        ds = ds.map(lambda xx: tf.parse_single_example(xx, {'index': tf.FixedLenFeature([], tf.int64)})['index'])
+        idx = ds.make_one_shot_iterator().get_next()
+
+        indices = []
+        with tf.Session() as sess:
+            try:
+                while True:
+                    indices.append(int(sess.run(idx)))
+            except tf.errors.OutOfRangeError:
+                pass
+
+    return indices
+
+@pytest.mark.parametrize('counts', [[7, 7], [5, 1, 4, 1, 5], [3, 3, 3, 3, 3, 3, 3, 3]])
+@pytest.mark.parametrize('training', [True, False])
+def test_shards_partition_records(tmpdir, counts, training):
+    files = _write_files(tmpdir, counts)
+    n_workers = 4
+
+    shards = [_read_indices(files, (n_workers, rank), training) for rank in range(n_workers)]
+
+    all_indices = [i for shard in shards for i in shard]
+    assert len(all_indices) == len(set(all_indices)), 'shards overlap'
+    assert sorted(all_indices) == list(range(sum(counts)))
+    sizes = [len(shard) for shard in shards]
+    assert max(sizes) - min(sizes) <= 1
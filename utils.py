@@ -1,6 +1,15 @@
+import os
+import json
+import glob
+import threading
+import queue
+import collections
 import numpy as np
 import tensorflow as tf
-import matplotlib.pyplot as plt
+
+TFRECORD_VERSION = 2 # Version of the record schema written by generate_TFRecords
+TFRECORD_DTYPES = {'float64': tf.float64, 'float32': tf.float32, 'float16': tf.float16}
+DEFAULT_FLUSH_EVERY = 10 # Number of batches written between flushes of SR output to disk
 
 def conv_layer_2d(x, filter_shape, stride, trainable=True):
     W = tf.get_variable(
@@ -23,8 +32,15 @@ def conv_layer_2d(x, filter_shape, stride, trainable=True):
 
     return x
 
-def deconv_layer_2d(x, filter_shape, output_shape, stride, trainable=True):
-    x = tf.pad(x, [[0,0], [3,3], [3,3], [0,0]], mode='reflect')
+def deconv_layer_2d(x, filter_shape, output_shape, stride, trainable=True, as_conv=False):
+    '''
+        Reflect-padded transposed convolution. With as_conv the same layer (same variables and output)
+        is computed as a regular convolution: a stride-1 'SAME' transposed convolution equals a
+        convolution with the spatially flipped, channel-transposed kernel, and only k//2 pixels of
+        the reflect padding reach the cropped output.
+    '''
+    if not as_conv:
+        x = tf.pad(x, [[0,0], [3,3], [3,3], [0,0]], mode='reflect')
     W = tf.get_variable(
         name='weight',
         shape=filter_shape,
@@ -37,6 +53,14 @@ def deconv_layer_2d(x, filter_shape, output_shape, stride, trainable=True):
         dtype=tf.float32,
         initializer=tf.contrib.layers.xavier_initializer(),
         trainable=trainable)
+
+    if as_conv:
+        assert stride == 1, 'as_conv requires a stride of 1'
+        p = filter_shape[0]//2
+        x = tf.pad(x, [[0,0], [p,p], [p,p], [0,0]], mode='reflect')
+        W_conv = tf.transpose(tf.reverse(W, [0, 1]), [0, 1, 3, 2])
+        return tf.nn.bias_add(tf.nn.conv2d(x, W_conv, strides=[1, 1, 1, 1], padding='VALID'), b)
+
     x = tf.nn.bias_add(tf.nn.conv2d_transpose(
         value=x,
         filter=W,
@@ -88,41 +112,434 @@ def pixel_shuffle_layer(x, r, n_split):
 
     return x
 
-def plot_SR_data(idx, LR, SR, path):
+def tile_windows(n, tile_size, halo):
+    '''
+        Split one spatial dimension of length n into tiles with a halo of context on either side.
+        Windows near the domain edge are shifted inward so that every window has the same length.
+
+        inputs:
+            n         - (int) length of the dimension in LR pixels
+            tile_size - (int) length of the tile interior kept in the output
+            halo      - (int) number of LR pixels of context added to each side of a tile
+
+        outputs:
+            windows - list of (core_start, core_end, window_start, window_end) tuples
+    '''
+    win = min(n, tile_size + 2*halo)
+    windows = []
+    for c0 in range(0, n, tile_size):
+        c1 = min(c0 + tile_size, n)
+        w0 = min(max(c0 - halo, 0), n - win)
+        windows.append((c0, c1, w0, w0 + win))
+
+    return windows
+
+def tiled_super_resolve(sr_func, LR, R, tile_size, halo, batch_size):
+    '''
+        Super-resolve a batch of LR images tile by tile so that peak memory is bounded by
+        the tile size rather than the domain size. Each output pixel is taken from the tile
+        whose interior contains it, so the halo is discarded and tiles never need blending.
+
+        inputs:
+            sr_func    - function mapping an (N, h, w, C) LR array to an (N, R*h, R*w, C) SR array
+            LR         - (N, h, w, C) array of LR images
+            R          - (int) total super-resolution factor, i.e. np.prod(r)
+            tile_size  - (int) height/width of the tile interior in LR pixels
+            halo       - (int) number of LR pixels of context around each tile
+            batch_size - (int) number of tiles to pass to sr_func at once
+
+        outputs:
+            SR - (N, R*h, R*w, C) array of SR images
+    '''
+    N, h, w, C = LR.shape
+    jobs = [(i, rows, cols) for i in range(N)
+                            for rows in tile_windows(h, tile_size, halo)
+                            for cols in tile_windows(w, tile_size, halo)]
+
+    SR = None
+    for b in range(0, len(jobs), batch_size):
+        batch_jobs = jobs[b:b+batch_size]
+        tiles = np.stack([LR[i, r_w0:r_w1, c_w0:c_w1, :] for i, (_, _, r_w0, r_w1), (_, _, c_w0, c_w1) in batch_jobs])
+        tiles_SR = sr_func(tiles)
+
+        if SR is None:
+            SR = np.empty((N, R*h, R*w, tiles_SR.shape[-1]), dtype=tiles_SR.dtype)
+
+        for tile_SR, (i, (r_c0, r_c1, r_w0, _), (c_c0, c_c1, c_w0, _)) in zip(tiles_SR, batch_jobs):
+            SR[i, R*r_c0:R*r_c1, R*c_c0:R*c_c1, :] = tile_SR[R*(r_c0 - r_w0):R*(r_c1 - r_w0),
+                                                             R*(c_c0 - c_w0):R*(c_c1 - c_w0), :]
+
+    return SR
+
+def import_frozen_generator(model_path, x_LR):
+    '''
+        Import a frozen generator written by PhIREGANs.export_generator into the default graph
+        inputs:
+            model_path - (string) path of the frozen generator (.pb)
+            x_LR       - LR input tensor in physical units
+
+        outputs:
+            x_SR - SR output tensor in physical units
+    '''
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(model_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    x_SR, = tf.import_graph_def(graph_def, input_map={'x_LR:0': x_LR}, return_elements=['x_SR:0'], name='generator')
+
+    return x_SR
+
+def expand_data_paths(data_path):
+    '''
+        Resolve a TFRecord path, glob pattern, or list of paths/patterns into a list of files
+        inputs:
+            data_path - (string or list of strings) paths or glob patterns of the tfrecords
+
+        outputs:
+            files - list of tfrecord paths, each pattern's matches in sorted order
+    '''
+    patterns = [data_path] if isinstance(data_path, str) else list(data_path)
+
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        assert len(matches) > 0, 'No data files match %s' %(pattern)
+        files.extend(matches)
+
+    return files
+
+def tfrecord_compression(data_path):
+    '''
+        Infer the compression of a TFRecord file from its extension
+        inputs:
+            data_path - (string) path to the tfrecord
+
+        outputs:
+            compression - (string) 'GZIP' for .gz, 'ZLIB' for .zlib, '' otherwise
+    '''
+    if data_path.endswith('.gz'):
+        return 'GZIP'
+    elif data_path.endswith('.zlib'):
+        return 'ZLIB'
+    return ''
+
+def decode_tfrecord_data(raw, dtype):
+    '''
+        Decode a raw data field of a TFRecord into a flat float32 tensor
+        inputs:
+            raw   - string tensor holding the raw bytes
+            dtype - string tensor naming the stored dtype ('float64', 'float32' or 'float16')
+
+        outputs:
+            data - flat float32 tensor
+    '''
+    return tf.case([(tf.equal(dtype, 'float32'), lambda: tf.decode_raw(raw, tf.float32)),
+                    (tf.equal(dtype, 'float16'), lambda: tf.cast(tf.decode_raw(raw, tf.float16), tf.float32))],
+                   default=lambda: tf.cast(tf.decode_raw(raw, tf.float64), tf.float32), exclusive=True)
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def serialize_example(index, data_LR, data_HR=None, dtype='float32'):
+    '''
+        Serialize one sample into the PhIREGANs TFRecord schema
+        inputs:
+            index   - (int) index of the sample
+            data_LR - (h_LR, w_LR, C) array of LR data, or None to store HR data only (LR synthesized in training)
+            data_HR - (h_HR, w_HR, C) array of HR data, or None for test data
+            dtype   - (string) dtype to store the data as: 'float64', 'float32' or 'float16'
+
+        outputs:
+            example - (bytes) serialized tf.train.Example
+    '''
+    assert data_LR is not None or data_HR is not None, 'Either LR or HR data must be given'
+    c = (data_LR if data_LR is not None else data_HR).shape[-1]
+    feature = {'index': _int64_feature(int(index)),
+                   'c': _int64_feature(c),
+             'version': _int64_feature(TFRECORD_VERSION),
+               'dtype': _bytes_feature(dtype.encode())}
+
+    if data_LR is not None:
+        h_LR, w_LR, _ = data_LR.shape
+        feature['data_LR'] = _bytes_feature(np.ascontiguousarray(data_LR, dtype=dtype).tobytes())
+        feature['h_LR'] = _int64_feature(h_LR)
+        feature['w_LR'] = _int64_feature(w_LR)
+
+    if data_HR is not None:
+        h_HR, w_HR, _ = data_HR.shape
+        feature['data_HR'] = _bytes_feature(np.ascontiguousarray(data_HR, dtype=dtype).tobytes())
+        feature['h_HR'] = _int64_feature(h_HR)
+        feature['w_HR'] = _int64_feature(w_HR)
+
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+def generate_TFRecords(filename, data_LR, data_HR=None, idx_start=0, dtype='float32', compression=None):
+    '''
+        Write NumPy arrays to a TFRecord file that the PhIREGANs parsers can read
+        inputs:
+            filename    - (string) path of the tfrecord to write
+            data_LR     - (N, h_LR, w_LR, C) array of LR data, or None to store HR data only
+            data_HR     - (N, h_HR, w_HR, C) array of HR data, or None for test data
+            idx_start   - (int) index of the first sample
+            dtype       - (string) dtype to store the data as: 'float64', 'float32' or 'float16'
+            compression - (string) None, 'GZIP' or 'ZLIB'. defaults to the compression implied by the file extension
+    '''
+    assert dtype in TFRECORD_DTYPES, 'dtype must be one of %s' %(list(TFRECORD_DTYPES))
+    if compression is None:
+        compression = tfrecord_compression(filename)
+
+    options = tf.python_io.TFRecordOptions(compression) if compression else None
+    with tf.python_io.TFRecordWriter(filename, options=options) as writer:
+        for i in range((data_LR if data_LR is not None else data_HR).shape[0]):
+            writer.write(serialize_example(idx_start + i, None if data_LR is None else data_LR[i],
+                                           None if data_HR is None else data_HR[i], dtype))
 
+class SRDataWriter(object):
+    '''
+        Streams batches of SR data into a preallocated, memory-mapped .npy file. Batches are
+        written from a background thread through a bounded queue, so disk I/O overlaps with
+        generator compute and memory use does not grow with the number of samples.
+
+        Batches with a done callback are flushed to disk in groups of flush_every, after which the
+        callbacks of the whole group are called, so the cost of syncing is shared by several batches.
+    '''
+    def __init__(self, path, N, max_queue=4, resume=False, flush_every=DEFAULT_FLUSH_EVERY):
+        '''
+            inputs:
+                path        - (string) path of the .npy file to write
+                N           - (int) total number of samples that will be written
+                max_queue   - (int) number of batches that may wait to be written before write() blocks
+                resume      - (bool) write into an existing file instead of a new one, keeping the rows already written
+                flush_every - (int) number of batches with a done callback written between flushes
+        '''
+        self.path, self.N, self.flush_every = path, N, flush_every
+        self.data, self.n_written, self.error = None, 0, None
+        self.pending = []
+
+        if resume and os.path.exists(path):
+            self.data = np.lib.format.open_memmap(path, mode='r+')
+            assert self.data.shape[0] == N, '%s holds %d samples, expected %d' %(path, self.data.shape[0], N)
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, batch, rows=None, done=None):
+        '''
+            inputs:
+                batch - (N_batch, ...) array of samples
+                rows  - (int array) output rows of the samples. None writes them after the previous batch
+                done  - function called once the batch has been flushed to disk, at the latest by close()
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((batch, rows, done))
+
+    def close(self, n_expected=None):
+        '''
+            inputs:
+                n_expected - (int) number of samples this writer should have written, defaults to N
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+        if self.data is not None:
+            self._flush()
+            self.data = None
+        n_expected = self.N if n_expected is None else n_expected
+        if self.n_written != n_expected:
+            print('Warning: expected %d samples but wrote %d to %s' %(n_expected, self.n_written, self.path))
+
+    def _flush(self):
+        self.data.flush()
+        for done in self.pending:
+            done()
+        self.pending = []
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            try:
+                batch, rows, done = item
+                if self.data is None:
+                    self.data = np.lib.format.open_memmap(self.path, mode='w+', dtype=batch.dtype,
+                                                          shape=(self.N,) + batch.shape[1:])
+                N_batch = batch.shape[0]
+                if rows is None:
+                    self.data[self.n_written:self.n_written+N_batch] = batch
+                else:
+                    self.data[rows] = batch
+                self.n_written += N_batch
+                if done is not None:
+                    self.pending.append(done)
+                    if len(self.pending) >= self.flush_every:
+                        self._flush()
+            except Exception as e:
+                self.error = e
+
+class ProgressLog(object):
+    '''
+        Append-only record of the sample indices an inference run has written, for resuming it.
+        <path>.json describes the run, <path>.log gets one line of indices per written batch.
+
+        Indices should only be recorded once their data is on disk, so the log never runs ahead of the
+        data. The log itself is synced on close() only: lines lost to a crash just mean their batches
+        are run again.
+    '''
+    def __init__(self, path, run, resume=False):
+        '''
+            inputs:
+                path   - (string) path of the progress files, without extension
+                run    - (dict) JSON-serializable description of the run. A run is only resumed if it matches
+                resume - (bool) keep the progress of a previous run, otherwise start over
+
+            outputs:
+                sets self.done, the set of indices already written
+        '''
+        self.path = path
+        self.done = set()
+
+        if resume and os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                previous = json.load(f)
+            assert previous == json.loads(json.dumps(run)), 'Cannot resume: %s.json describes a different run' %(path)
+
+            # Drop a line cut off by the interruption, its batch is simply run again
+            with open(path + '.log', 'rb+') as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    self.done.update(json.loads(line.decode()))
+                    end += len(line)
+                f.truncate(end)
+
+        else:
+            with open(path + '.json', 'w') as f:
+                json.dump(run, f, indent=2)
+            open(path + '.log', 'w').close()
+
+        self.file = open(path + '.log', 'a')
+        self.lock = threading.Lock()
+
+    def record(self, indices):
+        with self.lock:
+            self.file.write(json.dumps([int(i) for i in indices]) + '\n')
+            self.file.flush()
+            self.done.update(int(i) for i in indices)
+
+    def close(self):
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+_figure_templates = {}
+
+def _figure_template(LR_shape, SR_shape):
+    '''
+        Figure with one row of LR input and SR output panels per channel, built once per data shape
+        (and per process) and reused for every sample. Rendered with the Agg canvas directly, so no
+        interactive backend or pyplot state is involved.
+    '''
+    key = (LR_shape, SR_shape)
+    if key not in _figure_templates:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        C = LR_shape[-1]
+        fig = Figure(figsize=(12, 6*C))
+        FigureCanvasAgg(fig)
+
+        images = []
+        for c in range(C):
+            for col, (name, shape) in enumerate([('LR', LR_shape), ('SR', SR_shape)]):
+                ax = fig.add_subplot(C, 2, 2*c + col + 1)
+                im = ax.imshow(np.zeros(shape[:2]), cmap='viridis', origin='lower')
+                ax.set_title('%s %d %s' %(name, c, 'Input' if name == 'LR' else 'Output'), fontsize=9)
+                fig.colorbar(im, ax=ax)
+                ax.set_xticks([])
+                ax.set_yticks([])
+                images.append(im)
+
+        _figure_templates[key] = (fig, images)
+
+    return _figure_templates[key]
+
+def _render_SR_sample(idx, LR, SR, path, dpi):
+    fig, images = _figure_template(LR.shape, SR.shape)
+    for c in range(LR.shape[-1]):
+        vmin, vmax = np.min(SR[:, :, c]), np.max(SR[:, :, c])
+        for im, data in zip(images[2*c:2*c+2], [LR[:, :, c], SR[:, :, c]]):
+            im.set_data(data)
+            im.set_clim(vmin, vmax)
+
+    fig.savefig(path+'/img{0:05d}.png'.format(idx), dpi=dpi, bbox_inches='tight')
+
+def plot_SR_data(idx, LR, SR, path, dpi=200):
+    '''
+        Plot LR input and SR output of each sample to <path>/img<idx>.png, one row per channel
+    '''
     for i in range(LR.shape[0]):
-        vmin0, vmax0 = np.min(SR[i,:,:,0]), np.max(SR[i,:,:,0])
-        vmin1, vmax1 = np.min(SR[i,:,:,1]), np.max(SR[i,:,:,1])
-
-        plt.figure(figsize=(12, 12))
-        
-        plt.subplot(221)
-        plt.imshow(LR[i, :, :, 0], vmin=vmin0, vmax=vmax0, cmap='viridis', origin='lower')
-        plt.title('LR 0 Input', fontsize=9)
-        plt.colorbar()
-        plt.xticks([], [])
-        plt.yticks([], [])
-        
-        plt.subplot(223)
-        plt.imshow(LR[i, :, :, 1], vmin=vmin1, vmax=vmax1, cmap='viridis', origin='lower')
-        plt.title('LR 1 Input', fontsize=9)
-        plt.colorbar()
-        plt.xticks([], [])
-        plt.yticks([], [])
-        
-        plt.subplot(222)
-        plt.imshow(SR[i, :, :, 0], vmin=vmin0, vmax=vmax0, cmap='viridis', origin='lower')
-        plt.title('SR 0 Output', fontsize=9)
-        plt.colorbar()
-        plt.xticks([], [])
-        plt.yticks([], [])
-        
-        plt.subplot(224)
-        plt.imshow(SR[i, :, :, 1], vmin=vmin1, vmax=vmax1, cmap='viridis', origin='lower')
-        plt.title('SR 1 Output', fontsize=9)
-        plt.colorbar()
-        plt.xticks([], [])
-        plt.yticks([], [])
-
-        plt.savefig(path+'/img{0:05d}.png'.format(idx[i]), dpi=200, bbox_inches='tight')
-        plt.close()
\ No newline at end of file
+        _render_SR_sample(idx[i], LR[i], SR[i], path, dpi)
+
+class SRPlotter(object):
+    '''
+        Renders the plot_SR_data images in a pool of worker processes, so inference does not wait
+        on matplotlib. At most max_queue samples wait to be rendered before plot() blocks, which
+        bounds memory when rendering is slower than inference.
+    '''
+    def __init__(self, path, n_workers=None, max_queue=None, dpi=200, every=1):
+        '''
+            The workers are forked when the plotter is created, so create it before starting a session.
+
+            inputs:
+                path      - (string) directory to write the images to
+                n_workers - (int) number of rendering processes, defaults to one less than the number of cores
+                max_queue - (int) number of samples that may wait to be rendered, defaults to 4*n_workers
+                dpi       - (int) image resolution, lower it for quick previews
+                every     - (int) only render samples whose index is a multiple of every
+        '''
+        import multiprocessing as mp
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if n_workers is None:
+            n_workers = max(os.cpu_count() - 1, 1)
+
+        self.path, self.dpi, self.every = path, dpi, every
+        self.max_queue = max_queue if max_queue is not None else 4*n_workers
+        self.pending = collections.deque()
+
+        context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        self.pool = context.Pool(n_workers)
+
+    def plot(self, idx, LR, SR):
+        '''
+            Queue a batch of samples for rendering
+        '''
+        for i in range(LR.shape[0]):
+            if idx[i] % self.every != 0:
+                continue
+            while len(self.pending) >= self.max_queue:
+                self.pending.popleft().get()
+            self.pending.append(self.pool.apply_async(_render_SR_sample, (idx[i], LR[i], SR[i], self.path, self.dpi)))
+
+    def close(self):
+        '''
+            Wait for all queued images to be written
+        '''
+        try:
+            while self.pending:
+                self.pending.popleft().get()
+        finally:
+            self.pool.close()
+            self.pool.join()